@@ -1,78 +1,257 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import Optional, List, Dict
-import os, requests, tempfile, math
-from faster_whisper import WhisperModel
+import os, requests, tempfile, math, time, json, shutil, contextlib
+from faster_whisper.audio import decode_audio
+import longform, align
+from registry import ModelRegistry
 
 api=FastAPI(title="FFactory ASR")
 ASR_MODEL=os.getenv("MODEL_SIZE","medium")
 LANG=os.getenv("LANGUAGE")
 HF=os.getenv("HUGGINGFACE_TOKEN","").strip()
+# الملفات الأطول من هذا (بالثواني) تُفرّغ بالتقسيم المتوازي تلقائياً
+LONG_AUDIO_SEC=float(os.getenv("ASR_LONG_AUDIO_SEC","600"))
+CHUNK=int(os.getenv("ASR_SPOOL_CHUNK_BYTES", str(1024*1024)))
+# جذور المجلدات المشتركة المسموح القراءة منها مباشرة (path)
+SHARED_ROOTS=[os.path.realpath(p) for p in os.getenv("ASR_SHARED_ROOTS","/data,/evidence").split(",") if p.strip()]
+MINIO_URL=os.getenv("MINIO_URL","http://minio:9000")
 
-model=WhisperModel(ASR_MODEL, device="cpu", compute_type="int8")
+PRELOAD_DIAR=os.getenv("ASR_PRELOAD_DIARIZATION","0")=="1"
 
-# diarization lazy
+models=ModelRegistry(ASR_MODEL)
+
+# diarization lazy (أو مسبقاً عند الإقلاع مع ASR_PRELOAD_DIARIZATION=1)
 _diar=None
+_diar_load_sec=None
 def get_diar():
-    global _diar
+    global _diar, _diar_load_sec
     if _diar is not None: return _diar
     if not HF: return None
     from pyannote.audio import Pipeline
+    t0=time.time()
     _diar = Pipeline.from_pretrained("pyannote/speaker-diarization-3.1", use_auth_token=HF)
+    _diar_load_sec=round(time.time()-t0,3)
     return _diar
 
+@api.on_event("startup")
+def startup():
+    models.preload()
+    if HF and PRELOAD_DIAR:
+        # رمز HF ملغى/مقيّد أو لا شبكة: لا نُسقط الخدمة عند الإقلاع، يبقى التحميل lazy
+        try: get_diar()
+        except Exception as e: print(f"[asr-engine] diarization preload failed, staying lazy: {e}", flush=True)
+
 @api.get("/health")
 def health():
-    return {"status":"ok","model":ASR_MODEL,"lang":LANG,"diarization":bool(HF)}
+    return {"status":"ok","model":models.default,"lang":LANG,"diarization":bool(HF),
+            "diarization_loaded":_diar is not None,"diarization_load_sec":_diar_load_sec,
+            "models":models.stats(),
+            "long_audio":{"threshold_sec":LONG_AUDIO_SEC,"chunk_sec":longform.CHUNK_SEC,"workers":longform.WORKERS}}
+
+@api.on_event("shutdown")
+def shutdown():
+    longform.shutdown()
+
+class ModelReq(BaseModel):
+    size: str
+    warm: Optional[bool]=True
+
+@api.get("/models")
+def list_models():
+    return models.stats()
+
+@api.post("/models/load")
+def load_model(req: ModelReq):
+    """تحميل (أو إعادة تحميل/استبدال) حجم نموذج أثناء التشغيل."""
+    try: return models.load(req.size, warm=bool(req.warm))
+    except Exception as e: raise HTTPException(400, str(e))
+
+@api.post("/models/unload")
+def unload_model(req: ModelReq):
+    try: ok=models.unload(req.size)
+    except ValueError as e: raise HTTPException(409, str(e))
+    longform.shutdown(req.size)
+    return {"unloaded": ok}
+
+@api.post("/models/default")
+def default_model(req: ModelReq):
+    try: models.set_default(req.size)
+    except Exception as e: raise HTTPException(400, str(e))
+    return models.stats()
 
 class TranscribeIn(BaseModel):
-    audio_url:str
+    audio_url: Optional[str]=None     # HTTP(S)
+    bucket: Optional[str]=None        # مرجع MinIO (bucket + key)
+    key: Optional[str]=None
+    path: Optional[str]=None          # ملف على مجلد مشترك (ASR_SHARED_ROOTS)
     language: Optional[str]=None
     diarize: Optional[bool]=False
+    long_audio: Optional[bool]=None   # None = تلقائي حسب ASR_LONG_AUDIO_SEC
+    model: Optional[str]=None         # حجم النموذج من السجل (الافتراضي: MODEL_SIZE)
+
+class TranscribeStreamIn(TranscribeIn):
+    format: Optional[str]="ndjson"    # ndjson | sse
+
+_minio=None
+def get_minio():
+    global _minio
+    if _minio is None:
+        from minio import Minio
+        _minio=Minio(MINIO_URL.replace("http://","").replace("https://",""),
+                     access_key=os.getenv("MINIO_ACCESS_KEY"), secret_key=os.getenv("MINIO_SECRET_KEY"),
+                     secure=MINIO_URL.startswith("https"))
+    return _minio
+
+def _spool(chunks, f):
+    for b in chunks:
+        if b: f.write(b)
+    f.flush()
+
+@contextlib.contextmanager
+def local_audio(inp):
+    """مسار محلي للصوت دون تحميل الجسم كاملاً في الذاكرة: المسار المشترك يُستخدم
+    كما هو، و URL/MinIO تُنسخ إلى ملف مؤقت على دفعات CHUNK."""
+    if inp.path:
+        real=os.path.realpath(inp.path)
+        if not any(real==r or real.startswith(r+os.sep) for r in SHARED_ROOTS):
+            raise HTTPException(403, "path outside ASR_SHARED_ROOTS")
+        if not os.path.isfile(real): raise HTTPException(404, "path not found")
+        yield real; return
+    with tempfile.NamedTemporaryFile(suffix=".audio") as f:
+        if inp.bucket and inp.key:
+            resp=get_minio().get_object(inp.bucket, inp.key)
+            try: _spool(resp.stream(CHUNK), f)
+            finally: resp.close(); resp.release_conn()
+        elif inp.audio_url:
+            with requests.get(inp.audio_url, timeout=60, stream=True) as r:
+                r.raise_for_status(); _spool(r.iter_content(CHUNK), f)
+        else:
+            raise HTTPException(422, "one of audio_url, bucket+key or path is required")
+        yield f.name
+
+@contextlib.contextmanager
+def uploaded_audio(upload: UploadFile):
+    """UploadFile مُخزّن أصلاً في SpooledTemporaryFile؛ ننسخه لملف مسمّى على دفعات."""
+    with tempfile.NamedTemporaryFile(suffix=".audio") as f:
+        shutil.copyfileobj(upload.file, f, CHUNK); f.flush()
+        yield f.name
+
+def _run(audio, inp):
+    """يبدأ التفريغ ويعيد (meta, مولّد (segment, words)) بالترتيب كما تُنتج."""
+    duration=len(audio)/longform.SR
+    long_mode=inp.long_audio if inp.long_audio is not None else duration>=LONG_AUDIO_SEC
+    language=inp.language or LANG
+    try: size, model = models.get(inp.model)
+    except KeyError as e: raise HTTPException(400, str(e))
+    if long_mode:
+        meta={"language": language, "duration": duration, "long_audio": True, "workers": longform.WORKERS,
+              "model": size}
+        chunks=longform.iter_long(audio, size, language=language)
+        # اللغة غير محددة: ننتظر أول مقطع (مكتشفة فيه) قبل إرجاع meta، فحدث info في البث
+        # يحملها كما في المسار القصير بدل null؛ بقية المقاطع تُفك بالتوازي أثناء الانتظار
+        first=next(chunks, None) if language is None else None
+        if first: meta["language"]=first[1]
+        def gen():
+            if first: yield from first[0]
+            for pairs, lang, _ in chunks:
+                meta["language"]=meta["language"] or lang
+                yield from pairs
+        return meta, gen()
+    segs, info = model.transcribe(
+        audio,
+        language=language,
+        vad_filter=True, vad_parameters=dict(min_silence_duration_ms=300),
+        word_timestamps=True, beam_size=5
+    )
+    return ({"language": info.language, "duration": float(info.duration or 0.0), "long_audio": False,
+             "model": size},
+            (longform.segment_dict(s) for s in segs))
+
+def _diarize(path, words):
+    """تشغيل pyannote وإسناد متحدث لكل كلمة (في المكان)؛ يعيد قائمة الأدوار."""
+    diar = get_diar()
+    res = diar(path)
+    spk=[]
+    for turn, track, label in res.itertracks(yield_label=True):
+        spk.append({"start": float(turn.start), "end": float(turn.end), "speaker": label})
+    # أكبر تداخل زمني عبر مسح مرتب (align.py)
+    align.assign_speakers(words, spk)
+    return spk
+
+def transcribe_file(path, inp):
+    t0=time.time()
+    audio=decode_audio(path, sampling_rate=longform.SR)
+    meta, pairs = _run(audio, inp)
+    segments, words = [], []
+    for seg, w in pairs:
+        segments.append(seg); words += w
+    elapsed=time.time()-t0
+    out={**meta, "text":"".join(s["text"] for s in segments).strip(),
+         "segments": segments, "words": words, "elapsed_sec": round(elapsed,3),
+         "rtf": round(elapsed/meta["duration"],4) if meta["duration"] else None}
+    if inp.diarize and HF:
+        out["speakers"]=_diarize(path, out["words"])
+    return out
+
+def stream_file(source, inp, sse):
+    """مولّد الأحداث: info ثم segment لكل مقطع، ثم speakers (patch بمتحدث كل كلمة
+    حسب ترتيبها) ثم done. source سياق يعطي مساراً محلياً ويُغلق بانتهاء البث.
+    info يحمل اللغة المكتشفة دائماً؛ في الوضع الطويل بلا language يصدر بعد فك أول قطعة."""
+    def emit(event, data):
+        if sse: return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+        return json.dumps({"event": event, **data}, ensure_ascii=False)+"\n"
+    try:
+        with source as path:
+            t0=time.time()
+            audio=decode_audio(path, sampling_rate=longform.SR)
+            meta, pairs = _run(audio, inp)
+            yield emit("info", meta)
+            words=[] if inp.diarize and HF else None
+            n=0
+            for seg, w in pairs:
+                yield emit("segment", {"index": n, **seg, "words": w}); n+=1
+                if words is not None: words += w
+            elapsed=time.time()-t0
+            if words is not None:
+                spk=_diarize(path, words)
+                yield emit("speakers", {"speakers": spk, "word_speakers": [w.get("speaker") for w in words]})
+            yield emit("done", {"segments": n, "elapsed_sec": round(elapsed,3),
+                                "rtf": round(elapsed/meta["duration"],4) if meta["duration"] else None})
+    except Exception as e:
+        yield emit("error", {"detail": getattr(e, "detail", None) or str(e)})
+
+def _stream_response(source, inp, fmt):
+    sse=(fmt or "ndjson").lower()=="sse"
+    return StreamingResponse(stream_file(source, inp, sse),
+                             media_type="text/event-stream" if sse else "application/x-ndjson")
 
 @api.post("/transcribe")
 def transcribe(inp:TranscribeIn):
     try:
-        r=requests.get(inp.audio_url, timeout=60); r.raise_for_status()
-        with tempfile.NamedTemporaryFile(suffix=".wav") as f:
-            f.write(r.content); f.flush()
-            segs, info = model.transcribe(
-                f.name,
-                language=inp.language or LANG,
-                vad_filter=True, vad_parameters=dict(min_silence_duration_ms=300),
-                word_timestamps=True, beam_size=5
-            )
-            segments=[]
-            words=[]
-            for s in segs:
-                segments.append({
-                    "start": float(s.start or 0.0),
-                    "end": float(s.end or 0.0),
-                    "text": s.text.strip(),
-                    "avg_logprob": getattr(s, "avg_logprob", None),
-                    "no_speech_prob": getattr(s, "no_speech_prob", None),
-                })
-                if s.words:
-                    for w in s.words:
-                        words.append({"start": float(w.start or 0.0),
-                                      "end": float(w.end or 0.0),
-                                      "word": w.word})
-            out={"language": info.language, "duration": float(info.duration or 0.0),
-                 "text":"".join(s["text"] for s in segments).strip(),
-                 "segments": segments, "words": words}
-
-            if inp.diarize and HF:
-                diar = get_diar()
-                res = diar(f.name)
-                spk=[]
-                for turn, track, label in res.itertracks(yield_label=True):
-                    spk.append({"start": float(turn.start), "end": float(turn.end), "speaker": label})
-                # greedy alignment words -> speakers by overlap
-                for w in out["words"]:
-                    mid=(w["start"]+w["end"])/2.0
-                    owners=[s for s in spk if s["start"]<=mid<=s["end"]]
-                    if owners: w["speaker"]=owners[0]["speaker"]
-                out["speakers"]=spk
-            return out
+        with local_audio(inp) as path:
+            return transcribe_file(path, inp)
+    except HTTPException: raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api.post("/transcribe/stream")
+def transcribe_stream(inp:TranscribeStreamIn):
+    """نفس /transcribe لكن يبث الأحداث فور إنتاجها (NDJSON أو SSE)."""
+    return _stream_response(local_audio(inp), inp, inp.format)
+
+@api.post("/transcribe/upload")
+def transcribe_upload(file: UploadFile=File(...), language: Optional[str]=Form(None),
+                      diarize: bool=Form(False), long_audio: Optional[bool]=Form(None),
+                      model: Optional[str]=Form(None), stream: bool=Form(False), format: str=Form("ndjson")):
+    """رفع multipart (حقل file) كما يرسله ingest-worker."""
+    inp=TranscribeIn(language=language, diarize=diarize, long_audio=long_audio, model=model)
+    if stream:
+        return _stream_response(uploaded_audio(file), inp, format)
+    try:
+        with uploaded_audio(file) as path:
+            return transcribe_file(path, inp)
+    except HTTPException: raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,88 @@
+"""تفريغ الملفات الطويلة: تقسيم الصوت بالـ VAD عند فترات الصمت إلى قطع، ثم
+تفريغ القطع بالتوازي على pool من العمليات، لكل عملية WhisperModel خاص (int8).
+
+الوحدة منفصلة عن app.py عمداً: العمليات تُنشأ بـ spawn فتستورد هذه الوحدة فقط،
+ولا تعيد تحميل النموذج المحمّل على مستوى app.py.
+"""
+import os
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+SR = 16000
+CHUNK_SEC = float(os.getenv("ASR_CHUNK_SEC", "300"))
+WORKERS = int(os.getenv("ASR_PARALLEL_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+SPLIT_MIN_SILENCE_MS = int(os.getenv("ASR_SPLIT_MIN_SILENCE_MS", "500"))
+PAD = int(0.2 * SR)
+
+_model = None
+_pools = {}
+
+def _init(model_size, cpu_threads):
+    global _model
+    from faster_whisper import WhisperModel
+    _model = WhisperModel(model_size, device="cpu", compute_type="int8", cpu_threads=cpu_threads)
+
+def segment_dict(s, offset=0.0):
+    """segment واحد من faster-whisper → (segment, words) مع إزاحة زمنية."""
+    seg = {
+        "start": float(s.start or 0.0) + offset,
+        "end": float(s.end or 0.0) + offset,
+        "text": s.text.strip(),
+        "avg_logprob": getattr(s, "avg_logprob", None),
+        "no_speech_prob": getattr(s, "no_speech_prob", None),
+    }
+    words = [{"start": float(w.start or 0.0) + offset,
+              "end": float(w.end or 0.0) + offset,
+              "word": w.word} for w in (s.words or [])]
+    return seg, words
+
+def _run_chunk(audio, offset, language, beam_size):
+    segs, info = _model.transcribe(
+        audio, language=language,
+        vad_filter=True, vad_parameters=dict(min_silence_duration_ms=300),
+        word_timestamps=True, beam_size=beam_size
+    )
+    return [segment_dict(s, offset) for s in segs], info.language
+
+def split_on_silence(audio):
+    """حدود القطع (بالعينات): نجمع مقاطع الكلام حتى CHUNK_SEC ونقطع في الصمت بينها."""
+    from faster_whisper.vad import get_speech_timestamps, VadOptions
+    speech = get_speech_timestamps(audio, VadOptions(min_silence_duration_ms=SPLIT_MIN_SILENCE_MS,
+                                                     max_speech_duration_s=CHUNK_SEC))
+    max_len, chunks, cur = int(CHUNK_SEC * SR), [], None
+    for ts in speech:
+        if cur is None:
+            cur = [ts["start"], ts["end"]]
+        elif ts["end"] - cur[0] > max_len:
+            chunks.append(cur); cur = [ts["start"], ts["end"]]
+        else:
+            cur[1] = ts["end"]
+    if cur: chunks.append(cur)
+    return [(max(0, s - PAD), min(len(audio), e + PAD)) for s, e in chunks]
+
+def get_pool(model_size):
+    pool = _pools.get(model_size)
+    if pool is None:
+        threads = max(1, (os.cpu_count() or 1) // WORKERS)
+        pool = ProcessPoolExecutor(max_workers=WORKERS, mp_context=mp.get_context("spawn"),
+                                   initializer=_init, initargs=(model_size, threads))
+        _pools[model_size] = pool
+    return pool
+
+def iter_long(audio, model_size, language=None, beam_size=5):
+    """يقسم ثم يرسل كل القطع للـ pool، ويعيد نتائجها بالترتيب فور جاهزية كل قطعة:
+    (pairs, lang, samples) حيث pairs قائمة (segment, words)."""
+    bounds = split_on_silence(audio)
+    pool = get_pool(model_size)
+    futs = [pool.submit(_run_chunk, audio[s:e], s / SR, language, beam_size) for s, e in bounds]
+    try:
+        for (s, e), f in zip(bounds, futs):
+            pairs, lang = f.result()
+            yield pairs, lang, e - s
+    finally:
+        for f in futs: f.cancel()
+
+def shutdown(model_size=None):
+    for k in [model_size] if model_size else list(_pools):
+        p = _pools.pop(k, None)
+        if p: p.shutdown(cancel_futures=True)
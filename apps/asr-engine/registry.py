@@ -0,0 +1,83 @@
+"""سجل نماذج Whisper: تحميل مسبق لعدة أحجام (مثلاً small للفرز و medium
+للتفريغ النهائي)، تسخين كل نموذج بفك تشفير صوت صامت، واستبدال/إزالة
+النماذج أثناء التشغيل دون إعادة تشغيل الحاوية.
+
+الاستبدال ذري: النموذج الجديد يُبنى خارج القفل ثم يُوضع في السجل، والطلبات
+الجارية تحتفظ بمرجعها للنموذج القديم حتى تنتهي.
+"""
+import os, time, threading
+import numpy as np
+from faster_whisper import WhisperModel
+
+DEFAULT = os.getenv("MODEL_SIZE", "medium")
+PRELOAD = [m.strip() for m in os.getenv("ASR_PRELOAD_MODELS", DEFAULT).split(",") if m.strip()]
+LAZY_LOAD = os.getenv("ASR_LAZY_LOAD", "0") == "1"
+COMPUTE_TYPE = os.getenv("ASR_COMPUTE_TYPE", "int8")
+
+def _rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"): return int(line.split()[1]) / 1024.0
+    except OSError: pass
+    return None
+
+class ModelRegistry:
+    def __init__(self, default=DEFAULT):
+        self.default = default
+        self._models = {}   # size -> (model, info)
+        self._lock = threading.Lock()
+        self._loading = {}  # size -> Lock (تحميل واحد لكل حجم في نفس الوقت)
+
+    def load(self, size: str, warm: bool = True) -> dict:
+        with self._lock:
+            gate = self._loading.setdefault(size, threading.Lock())
+        with gate:
+            rss0, t0 = _rss_mb(), time.time()
+            m = WhisperModel(size, device="cpu", compute_type=COMPUTE_TYPE)
+            load_sec = time.time() - t0
+            warm_sec = None
+            if warm:
+                t1 = time.time()
+                segs, _ = m.transcribe(np.zeros(16000, dtype=np.float32), beam_size=1, language="en")
+                for _ in segs: pass
+                warm_sec = time.time() - t1
+            rss1 = _rss_mb()
+            info = {"size": size, "compute_type": COMPUTE_TYPE, "load_sec": round(load_sec, 3),
+                    "warm_sec": round(warm_sec, 3) if warm_sec is not None else None,
+                    "rss_delta_mb": round(rss1 - rss0, 1) if rss0 is not None and rss1 is not None else None,
+                    "loaded_at": time.time(), "requests": 0}
+            with self._lock:
+                self._models[size] = (m, info)
+            return info
+
+    def unload(self, size: str) -> bool:
+        with self._lock:
+            if size == self.default: raise ValueError("cannot unload the default model")
+            return self._models.pop(size, None) is not None
+
+    def set_default(self, size: str):
+        if size not in self._models: self.load(size)
+        self.default = size
+
+    def get(self, size: str | None = None):
+        size = size or self.default
+        for attempt in range(2):
+            with self._lock:
+                hit = self._models.get(size)
+                if hit is not None:
+                    hit[1]["requests"] += 1   # داخل القفل: لا زيادات ضائعة ولا سباق مع unload/swap
+                    return size, hit[0]
+            if attempt or not LAZY_LOAD: break
+            self.load(size)
+        raise KeyError(f"model '{size}' not loaded")
+
+    def preload(self, sizes=None):
+        for s in dict.fromkeys([self.default] + list(sizes or PRELOAD)):
+            self.load(s)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"default": self.default, "lazy_load": LAZY_LOAD,
+                    "models": {k: dict(v[1]) for k, v in self._models.items()},
+                    "process_rss_mb": _rss_mb()}
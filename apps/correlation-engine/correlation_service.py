@@ -1,11 +1,15 @@
 import os
 import json
-import psycopg2
 import psycopg2.extras as pgx
+from psycopg2.pool import ThreadedConnectionPool
+import threading
+import contextlib
+from collections import OrderedDict
 from neo4j import GraphDatabase, basic_auth
 from typing import Dict, List, Any, Optional
-from datetime import datetime, time
+from datetime import datetime
 import logging
+import time
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("CorrelationEngine")
@@ -14,6 +18,111 @@ logger = logging.getLogger("CorrelationEngine")
 DB_URL = os.getenv("DB_URL", "postgresql://forensic_user:password@db:5432/forensic_db")
 NEO4J_URI = os.getenv("NEO4J_URI", "bolt://neo4j:7687")
 NEO4J_AUTH_ENV = os.getenv("NEO4J_AUTH", "none")
+# pool اتصالات Postgres: endpoints المتزامنة تعمل على threadpool، فكل طلب يأخذ اتصاله
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "1"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", str(max(4, 2 * (os.cpu_count() or 2)))))
+NEO4J_POOL_SIZE = int(os.getenv("NEO4J_POOL_SIZE", str(max(8, 4 * (os.cpu_count() or 2)))))
+# حجم صفحة keyset = حجم دفعة UNWIND الواحدة
+ETL_BATCH_ROWS = int(os.getenv("ETL_BATCH_ROWS", "5000"))
+# لا نقرأ صفوفاً أحدث من هذا (ثوانٍ): معاملة بدأت قبل الـ watermark وتأكدت بعده لن تُفقد
+ETL_SAFETY_LAG_SEC = float(os.getenv("ETL_SAFETY_LAG_SEC", "5"))
+
+# --- مصادر الـ ETL التزايدي ---
+# كل مصدر: مفتاح keyset (ingested_at, key) — وقت الإدراج وليس وقت الحدث، فالأحداث
+# القديمة المُدرجة متأخراً لا تُفقد — واستعلام Cypher لدفعة UNWIND واحدة.
+SOURCES = {
+    "failures": {
+        "table": "decryption_failures", "key": "failure_id::text",
+        "cols": "failure_id, failure_type, failure_timestamp",
+        "row": lambda f, case_id: {"id": str(f["failure_id"]), "type": f["failure_type"],
+                                   "ts": f["failure_timestamp"].isoformat(), "case_id": case_id},
+        "cypher": """UNWIND $rows AS r
+                     MERGE (fail:Failure {id: r.id})
+                     SET fail += r, fail.severity = CASE WHEN r.type = 'CUSTOM_PROTECTION' THEN 'CRITICAL' ELSE 'HIGH' END
+                     MERGE (c:Case {id: r.case_id})
+                     MERGE (c)-[:HAD_FAILURE]->(fail)""",
+    },
+    "scans": {
+        "table": "scan_results", "key": "job_id::text || '/' || family",
+        "cols": "*",
+        "row": lambda s, case_id: {"sha256": s["sha256"], "score": int(s["score"]), "family": s["family"],
+                                   "case_id": case_id, "job_id": str(s["job_id"])} if s.get("sha256") else None,
+        "cypher": """UNWIND $rows AS r
+                     MERGE (f:File {hash: r.sha256})
+                     SET f += r
+                     MERGE (c:Case {id: r.case_id})
+                     MERGE (c)-[:INVOLVES_FILE]->(f)""",
+    },
+    "timeline": {
+        "table": "timeline_events", "key": "id::text",
+        "cols": "id, timestamp, description",
+        "row": lambda t, case_id: {"id": str(t["id"]), "ts": t["timestamp"].isoformat(), "desc": t["description"],
+                                   "case_id": case_id},
+        "cypher": """UNWIND $rows AS r
+                     MERGE (e:TimelineEvent {id: r.id})
+                     SET e += r
+                     MERGE (c:Case {id: r.case_id})
+                     MERGE (c)-[:HAS_EVENT]->(e)""",
+    },
+}
+
+# --- قواعد الفرضيات ---
+# كل قاعدة جزء Cypher يبدأ من عقدة القضية المربوطة c (قيد فريد → فهرس) ويعيد `value`
+# في صف واحد (تجميع)؛ كل القواعد تُجمع في استعلام واحد بـ CALL {} لكل قاعدة، فتكلفة
+# التحليل تتبع حجم القضية لا حجم الرسم كله. hypothesis(value) → فرضية أو None.
+RULES: List[Dict[str, Any]] = []
+RULE_CACHE_CASES = int(os.getenv("RULE_CACHE_CASES", "256"))
+
+def register_rule(name: str, cypher: str, hypothesis=None, output: Optional[str] = None):
+    """output: مفتاح في نتيجة التحليل تُوضع فيه value كما هي (مثل suspicious_paths)."""
+    RULES[:] = [r for r in RULES if r["name"] != name]
+    RULES.append({"name": name, "cypher": cypher, "hypothesis": hypothesis, "output": output})
+
+# القاعدة I: التغطية المتعمدة (CUSTOM_PROTECTION) — أي دليل واحد يكفي
+register_rule("custom_protection",
+    "MATCH (c)-[:HAD_FAILURE]->(f:Failure {type: 'CUSTOM_PROTECTION'}) RETURN count(f) AS value",
+    lambda n: {"severity": "CRITICAL", "type": "التغطية المتعمدة",
+               "reason": f"تم تسجيل {n} محاولة لحماية مخصصة/تشويش.",
+               "evidence_count": n, "confidence": 0.85} if n >= 1 else None)
+
+# القاعدة III: التناقض الزمني — حذف ملف (الخفي) بعد فشل (الظاهر) مرتبط به، داخل القضية
+register_rule("temporal_inconsistency",
+    """MATCH (c)-[:HAD_FAILURE]->(f:Failure)-[:RELATED_TO*1..2]-(t:TimelineEvent)<-[:HAS_EVENT]-(c)
+       WHERE coalesce(t.desc, t.description) CONTAINS 'File Deletion'
+         AND coalesce(t.ts, t.timestamp) > coalesce(f.ts, f.timestamp)
+       RETURN count(DISTINCT t) AS value""",
+    lambda n: {"severity": "HIGH", "type": "التناقض الزمني",
+               "reason": "تم حذف دليل خطير مباشرة بعد فشل فك التشفير. يجب فحص نية المحو.",
+               "evidence_count": n, "confidence": 0.80} if n > 0 else None)
+
+# المسارات المشبوهة: ملف عالي الخطورة ↔ فشل حرج، كلاهما من القضية
+register_rule("suspicious_paths",
+    """MATCH (c)-[:INVOLVES_FILE]->(f:File) WHERE f.risk_score > 70
+       MATCH (c)-[:HAD_FAILURE]->(fail:Failure {severity: 'CRITICAL'})
+       MATCH path = (f)-[*1..3]-(fail)
+       WITH path LIMIT 5
+       RETURN collect({path_summary: [n IN nodes(path) | labels(n)[0] + ':' + coalesce(n.hash, n.id)],
+                       path_len: length(path)}) AS value""",
+    output="suspicious_paths")
+
+def compile_rules(rules: List[Dict[str, Any]]) -> str:
+    q, carried = ["MATCH (c:Case {id: $case_id})"], []
+    for i, r in enumerate(rules):
+        q.append("CALL { WITH c " + r["cypher"] + " }")
+        carried.append(f"r{i}")
+        q.append("WITH c, " + ", ".join(carried[:-1] + [f"value AS r{i}"]))
+    q.append("RETURN " + (", ".join(carried) if carried else "c.id AS case_id"))
+    return "\n".join(q)
+
+ETL_SCHEMA = ["""CREATE TABLE IF NOT EXISTS etl_watermarks(
+                   case_id TEXT NOT NULL, source TEXT NOT NULL,
+                   last_ingested_at TIMESTAMPTZ, last_key TEXT,
+                   rows_total BIGINT NOT NULL DEFAULT 0, updated_at TIMESTAMPTZ DEFAULT now(),
+                   PRIMARY KEY(case_id, source))"""]
+for _src in SOURCES.values():
+    # DEFAULT now() ثابت (STABLE) → إضافة العمود لا تعيد كتابة الجدول (PG11+)
+    ETL_SCHEMA.append(f"ALTER TABLE {_src['table']} ADD COLUMN IF NOT EXISTS ingested_at TIMESTAMPTZ NOT NULL DEFAULT now()")
+    ETL_SCHEMA.append(f"CREATE INDEX IF NOT EXISTS {_src['table']}_case_ingested_idx ON {_src['table']}(case_id, ingested_at)")
 
 def _parse_neo4j_auth(auth_env: str) -> Optional[tuple]:
     auth_env = (auth_env or "").strip()
@@ -21,18 +130,73 @@ def _parse_neo4j_auth(auth_env: str) -> Optional[tuple]:
     if ":" in auth_env: return tuple(auth_env.split(":", 1))
     return None
 
+class PgPool:
+    """ThreadedConnectionPool آمن للخيوط: ينتظر اتصالاً متاحاً بدل رمي PoolError عند
+    الامتلاء، ويسجل عدد مرات الانتظار وزمنه."""
+    def __init__(self, dsn: str, minconn: int, maxconn: int):
+        self._pool = ThreadedConnectionPool(minconn, maxconn, dsn, connect_timeout=5,
+                                            application_name="correlation_engine")
+        self._sem = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self.minconn, self.maxconn = minconn, maxconn
+        self._open = set()   # اتصالات حية رأيناها (id)؛ الـ pool يغلق الفائض عند الإرجاع فنراه closed
+        self._m = {"checkouts": 0, "in_use": 0, "peak_in_use": 0, "waits": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0}
+
+    @contextlib.contextmanager
+    def connection(self):
+        """اتصال في معاملة: commit عند النجاح و rollback عند الخطأ."""
+        t0 = time.perf_counter()
+        waited = not self._sem.acquire(blocking=False)
+        if waited: self._sem.acquire()
+        wait_ms = (time.perf_counter() - t0) * 1000
+        with self._lock:
+            m = self._m
+            m["checkouts"] += 1; m["in_use"] += 1; m["peak_in_use"] = max(m["peak_in_use"], m["in_use"])
+            if waited:
+                m["waits"] += 1; m["wait_ms_total"] += wait_ms; m["wait_ms_max"] = max(m["wait_ms_max"], wait_ms)
+        conn = None
+        try:
+            conn = self._pool.getconn()
+            if conn.closed:
+                self._pool.putconn(conn, close=True); conn = self._pool.getconn()
+            with self._lock: self._open.add(id(conn))
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                if not conn.closed: conn.rollback()
+                raise
+        finally:
+            if conn is not None: self._pool.putconn(conn, close=bool(conn.closed))
+            with self._lock:
+                self._m["in_use"] -= 1
+                if conn is not None and conn.closed: self._open.discard(id(conn))
+            self._sem.release()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock: m = dict(self._m); opened = len(self._open)
+        m["wait_ms_total"] = round(m["wait_ms_total"], 1); m["wait_ms_max"] = round(m["wait_ms_max"], 1)
+        m["wait_ms_avg"] = round(m["wait_ms_total"] / m["waits"], 1) if m["waits"] else 0.0
+        return {"min": self.minconn, "max": self.maxconn, "open": opened, "idle": max(0, opened - m["in_use"]), **m}
+
+    def close(self):
+        self._pool.closeall()
+
 class CorrelationEngine:
     def __init__(self):
-        self.db_conn = None
+        self.pg: Optional[PgPool] = None
+        self._rule_cache: "OrderedDict[str, tuple]" = OrderedDict()   # case_id -> (data_version, result)
+        self._rule_lock = threading.Lock()
         self.neo4j_driver = None
         self._connect_databases()
         self._setup_neo4j_constraints()
+        self._setup_etl_schema()
     
     def _connect_databases(self):
         try:
-            self.db_conn = psycopg2.connect(DB_URL, connect_timeout=5, application_name="correlation_engine")
+            self.pg = PgPool(DB_URL, PG_POOL_MIN, PG_POOL_MAX)
             auth = _parse_neo4j_auth(NEO4J_AUTH_ENV)
-            self.neo4j_driver = GraphDatabase.driver(NEO4J_URI) if auth is None else GraphDatabase.driver(NEO4J_URI, auth=auth)
+            self.neo4j_driver = GraphDatabase.driver(NEO4J_URI, auth=auth, max_connection_pool_size=NEO4J_POOL_SIZE)
             self.neo4j_driver.verify_connectivity()
             logger.info("✅ DB connections ready.")
         except Exception as e:
@@ -44,122 +208,150 @@ class CorrelationEngine:
             session.run("CREATE CONSTRAINT person_id IF NOT EXISTS FOR (p:Person) REQUIRE p.id IS UNIQUE;")
             session.run("CREATE INDEX file_hash IF NOT EXISTS FOR (f:File) ON (f.hash);")
             session.run("CREATE INDEX event_ts IF NOT EXISTS FOR (e:TimelineEvent) ON (e.timestamp);")
+            session.run("CREATE CONSTRAINT case_id IF NOT EXISTS FOR (c:Case) REQUIRE c.id IS UNIQUE;")
+            session.run("CREATE CONSTRAINT failure_id IF NOT EXISTS FOR (f:Failure) REQUIRE f.id IS UNIQUE;")
+            session.run("CREATE CONSTRAINT timeline_event_id IF NOT EXISTS FOR (e:TimelineEvent) REQUIRE e.id IS UNIQUE;")
             logger.info("✅ Neo4j constraints set.")
 
+    def _setup_etl_schema(self):
+        with self.pg.connection() as conn, conn.cursor() as cur:
+            for q in ETL_SCHEMA: cur.execute(q)
+
     def close(self):
-        if self.db_conn: self.db_conn.close()
+        if self.pg: self.pg.close()
         if self.neo4j_driver: self.neo4j_driver.close()
 
-    def _extract_entities_from_postgres(self, case_id: str) -> Dict[str, list]:
-        """سحب البيانات الجنائية من Postgres."""
-        with self.db_conn.cursor(cursor_factory=pgx.DictCursor) as cur:
-            cur.execute("SELECT * FROM timeline_events WHERE case_id = %s ORDER BY timestamp ASC LIMIT 100", (case_id,))
-            timeline_events = [dict(row) for row in cur.fetchall()]
-            
-            cur.execute("SELECT * FROM decryption_failures WHERE case_id = %s", (case_id,))
-            failures = [dict(row) for row in cur.fetchall()]
+    def _watermark(self, case_id: str, source: str):
+        with self.pg.connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT last_ingested_at, last_key FROM etl_watermarks WHERE case_id=%s AND source=%s",
+                        (case_id, source))
+            return cur.fetchone() or (None, None)
 
-            cur.execute("SELECT * FROM scan_results WHERE case_id = %s", (case_id,))
-            scans = [dict(row) for row in cur.fetchall()]
+    def _pages(self, case_id: str, name: str, batch: int):
+        """صفحات keyset بعد الـ watermark: (rows, (ingested_at, key) لآخر صف)."""
+        src = SOURCES[name]
+        last_at, last_key = self._watermark(case_id, name)
+        while True:
+            # اتصال لكل صفحة: لا نحجز اتصالاً من الـ pool أثناء كتابة Neo4j
+            with self.pg.connection() as conn, conn.cursor(cursor_factory=pgx.DictCursor) as cur:
+                cur.execute(f"""SELECT {src['cols']}, ingested_at AS _wm_at, {src['key']} AS _wm_key
+                                FROM {src['table']}
+                                WHERE case_id = %(case)s
+                                  AND ingested_at < now() - make_interval(secs => %(lag)s)
+                                  AND (%(at)s::timestamptz IS NULL OR (ingested_at, {src['key']}) > (%(at)s, %(key)s))
+                                ORDER BY ingested_at, {src['key']}
+                                LIMIT %(n)s""",
+                            {"case": case_id, "lag": ETL_SAFETY_LAG_SEC, "at": last_at, "key": last_key, "n": batch})
+                rows = [dict(r) for r in cur.fetchall()]
+            if not rows: return
+            last_at, last_key = rows[-1]["_wm_at"], rows[-1]["_wm_key"]
+            yield rows, (last_at, last_key)
+            if len(rows) < batch: return
 
-        return {"timeline": timeline_events, "failures": failures, "scans": scans}
+    def _advance(self, case_id: str, source: str, mark, n: int):
+        with self.pg.connection() as conn, conn.cursor() as cur:
+            cur.execute("""INSERT INTO etl_watermarks(case_id, source, last_ingested_at, last_key, rows_total, updated_at)
+                           VALUES (%s, %s, %s, %s, %s, now())
+                           ON CONFLICT (case_id, source) DO UPDATE SET
+                             last_ingested_at = excluded.last_ingested_at, last_key = excluded.last_key,
+                             rows_total = etl_watermarks.rows_total + excluded.rows_total, updated_at = now()""",
+                        (case_id, source, mark[0], mark[1], n))
 
-    def _build_initial_graph(self, entities: Dict[str, list], case_id: str) -> None:
-        """بناء الرسم البياني في Neo4j (مع UNWIND)."""
+    def run_incremental_etl(self, case_id: str, batch: Optional[int] = None, full: bool = False) -> Dict[str, Any]:
+        """ينقل إلى Neo4j الصفوف الجديدة فقط منذ آخر تشغيل، على دفعات UNWIND.
+        الـ watermark يتقدم بعد نجاح كتابة كل دفعة؛ MERGE يجعل إعادة دفعة بعد عطل آمنة."""
+        batch = max(1, batch or ETL_BATCH_ROWS)
+        if full:
+            with self.pg.connection() as conn, conn.cursor() as cur:
+                cur.execute("DELETE FROM etl_watermarks WHERE case_id=%s", (case_id,))
+        t0 = time.time()
+        stats = {}
         with self.neo4j_driver.session() as session:
-            # 1. تحميل حالات الفشل
-            failure_rows = [{"id": str(f["failure_id"]), "type": f["failure_type"], "ts": f["failure_timestamp"].isoformat(), "case_id": case_id} for f in entities["failures"]]
-            if failure_rows:
-                 session.run("""UNWIND $rows AS r 
-                                MERGE (fail:Failure {id: r.id}) 
-                                SET fail += r, fail.severity = CASE WHEN r.type = 'CUSTOM_PROTECTION' THEN 'CRITICAL' ELSE 'HIGH' END 
-                                MERGE (c:Case {id: r.case_id}) 
-                                MERGE (c)-[:HAD_FAILURE]->(fail)""", rows=failure_rows)
-
-            # 2. تحميل نتائج المسح
-            scan_rows = [{"sha256": s["sha256"], "score": int(s["score"]), "family": s["family"], "case_id": case_id, "job_id": str(s["job_id"])} for s in entities["scans"] if s.get("sha256")]
-            if scan_rows:
-                session.run("""UNWIND $rows AS r 
-                                MERGE (f:File {hash: r.sha256}) 
-                                SET f += r 
-                                MERGE (c:Case {id: r.case_id}) 
-                                MERGE (c)-[:INVOLVES_FILE]->(f)""", rows=scan_rows)
-            
-            # 3. تحميل الأحداث الزمنية (Timeline Events)
-            timeline_rows = [{"id": str(t["id"]), "ts": t["timestamp"].isoformat(), "desc": t["description"], "case_id": case_id} for t in entities["timeline"]]
-            if timeline_rows:
-                session.run("""UNWIND $rows AS r
-                                MERGE (e:TimelineEvent {id: r.id})
-                                SET e += r 
-                                MERGE (c:Case {id: r.case_id}) 
-                                MERGE (c)-[:HAS_EVENT]->(e)""", rows=timeline_rows)
-            logger.info(f"✅ Graph built with {len(failure_rows)} failures and {len(scan_rows)} files.")
+            for name, src in SOURCES.items():
+                ts, n, pages = time.time(), 0, 0
+                for rows, mark in self._pages(case_id, name, batch):
+                    payload = [r for r in (src["row"](x, case_id) for x in rows) if r is not None]
+                    if payload:
+                        session.execute_write(lambda tx: tx.run(src["cypher"], rows=payload).consume())
+                    self._advance(case_id, name, mark, len(rows))
+                    n += len(rows); pages += 1
+                dt = time.time() - ts
+                stats[name] = {"rows": n, "batches": pages, "elapsed_sec": round(dt, 3),
+                               "rows_per_sec": round(n / dt) if dt > 0 and n else 0}
+        dt = time.time() - t0
+        total = sum(v["rows"] for v in stats.values())
+        logger.info(f"✅ Incremental ETL for {case_id}: {total} new rows in {dt:.2f}s")
+        return {"sources": stats, "rows": total, "elapsed_sec": round(dt, 3),
+                "rows_per_sec": round(total / dt) if dt > 0 and total else 0, "batch_rows": batch}
+
+    def etl_status(self, case_id: str) -> List[Dict[str, Any]]:
+        with self.pg.connection() as conn, conn.cursor(cursor_factory=pgx.RealDictCursor) as cur:
+            cur.execute("""SELECT source, last_ingested_at, last_key, rows_total, updated_at
+                           FROM etl_watermarks WHERE case_id=%s ORDER BY source""", (case_id,))
+            return [dict(r) for r in cur.fetchall()]
 
     # ----------------------------------------------------------
     # --- وحدة التفكير النقدي (Mindset Logic) ---
     # ----------------------------------------------------------
 
-    def _generate_investigator_hypotheses(self, case_id: str, entities: Dict[str, list]) -> List[Dict[str, Any]]:
-        hypotheses = []
-        
-        # 1. القاعدة I: التغطية المتعمدة (CUSTOM_PROTECTION)
-        custom_fail_count = sum(1 for f in entities.get("failures", []) if f.get("failure_type") == 'CUSTOM_PROTECTION')
-        if custom_fail_count >= 1: # نغيرها لـ 1 لأننا نبحث عن أي دليل
-            hypotheses.append({
-                "severity": "CRITICAL", "type": "التغطية المتعمدة",
-                "reason": f"تم تسجيل {custom_fail_count} محاولة لحماية مخصصة/تشويش.",
-                "evidence_count": custom_fail_count, "confidence": 0.85
-            })
-
-        # 2. القاعدة III: التناقض الزمني (Temporal Inconsistency)
-        with self.neo4j_driver.session() as session:
-            # البحث عن حدث حذف ملف (الخفي) حدث بعد فشل (الظاهر)
-            query_inconsistency = """
-            MATCH (f:Failure)
-            OPTIONAL MATCH (f)-[:RELATED_TO*1..2]-(t:TimelineEvent)
-            WHERE t.description CONTAINS 'File Deletion' AND t.timestamp > f.timestamp
-            WITH COUNT(t) AS suspicious_deletions
-            RETURN suspicious_deletions
-            """
-            inconsistency_check = session.run(query_inconsistency).single()
-            
-            if inconsistency_check and inconsistency_check['suspicious_deletions'] > 0:
-                 hypotheses.append({
-                    "severity": "HIGH", "type": "التناقض الزمني",
-                    "reason": "تم حذف دليل خطير مباشرة بعد فشل فك التشفير. يجب فحص نية المحو.",
-                    "evidence_count": inconsistency_check['suspicious_deletions'], "confidence": 0.80
-                })
-
-        return hypotheses
-
-    def _find_suspicious_paths(self) -> List[Dict[str, Any]]:
-        """إيجاد المسارات المشبوهة في الرسم البياني."""
-        query = """
-        MATCH path = (f:File)-[*1..3]-(fail:Failure)
-        WHERE f.risk_score > 70 AND fail.severity = 'CRITICAL'
-        RETURN [n IN nodes(path) | labels(n)[0] + ':' + coalesce(n.hash, n.id)] AS path_summary, length(path) AS path_len
-        LIMIT 5
-        """
+    def _data_version(self, case_id: str) -> tuple:
+        """يتغير عند وصول أي بيانات جديدة للقضية (من أي عامل): مجموع الصفوف المنقولة وآخر تحديث."""
+        with self.pg.connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT coalesce(sum(rows_total), 0), max(updated_at) FROM etl_watermarks WHERE case_id=%s",
+                        (case_id,))
+            return tuple(cur.fetchone())
+
+    def evaluate_rules(self, case_id: str, use_cache: bool = True) -> Dict[str, Any]:
+        """كل القواعد المسجلة في تمريرة واحدة مقيدة بالقضية؛ النتيجة محفوظة حتى تتغير بيانات القضية."""
+        t0 = time.perf_counter()
+        version = self._data_version(case_id)
+        if use_cache:
+            with self._rule_lock:
+                hit = self._rule_cache.get(case_id)
+                if hit and hit[0] == version:
+                    self._rule_cache.move_to_end(case_id)
+                    return {**hit[1], "cached": True, "elapsed_ms": round((time.perf_counter() - t0) * 1000, 2)}
+        rules = list(RULES)
         with self.neo4j_driver.session() as session:
-            return [rec.data() for rec in session.run(query)]
+            rec = session.execute_read(lambda tx: tx.run(compile_rules(rules), case_id=case_id).single())
+        result: Dict[str, Any] = {"hypotheses": [], "rules": {}}
+        for i, r in enumerate(rules):
+            value = rec[f"r{i}"] if rec is not None else None
+            result["rules"][r["name"]] = len(value) if isinstance(value, list) else value
+            if r["output"]: result[r["output"]] = value or []
+            if r["hypothesis"] and value is not None:
+                h = r["hypothesis"](value)
+                if h: result["hypotheses"].append({"rule": r["name"], **h})
+        with self._rule_lock:
+            self._rule_cache[case_id] = (version, result)
+            self._rule_cache.move_to_end(case_id)
+            while len(self._rule_cache) > RULE_CACHE_CASES: self._rule_cache.popitem(last=False)
+        return {**result, "cached": False, "elapsed_ms": round((time.perf_counter() - t0) * 1000, 2)}
+
+    def _generate_investigator_hypotheses(self, case_id: str) -> List[Dict[str, Any]]:
+        return self.evaluate_rules(case_id)["hypotheses"]
 
-    def run_correlation(self, case_id: str) -> Dict[str, Any]:
+    def run_correlation(self, case_id: str, batch: Optional[int] = None, full: bool = False) -> Dict[str, Any]:
         """دالة التشغيل الرئيسية المحدثة - المحقق الافتراضي."""
         logger.info(f"🔍 بدء التحليل الاستخباراتي للقضية: {case_id}")
         
-        entities = self._extract_entities_from_postgres(case_id)
-        self._build_initial_graph(entities, case_id)
+        etl = self.run_incremental_etl(case_id, batch, full)
         
-        hypotheses = self._generate_investigator_hypotheses(case_id, entities)
-        suspicious_paths = self._find_suspicious_paths()
+        analysis = self.evaluate_rules(case_id, use_cache=not full)
+        hypotheses = analysis["hypotheses"]
+        suspicious_paths = analysis.get("suspicious_paths", [])
         
         return {
             "status": "SUCCESS",
             "case_id": case_id,
             "analysis_timestamp": datetime.now().isoformat(),
+            "etl": etl,
             "critical_hypotheses": hypotheses,
             "suspicious_paths_found": len(suspicious_paths),
             "suspicious_paths": suspicious_paths,
+            "rules": analysis["rules"],
+            "rules_cached": analysis["cached"],
+            "rules_elapsed_ms": analysis["elapsed_ms"],
         }
 
 # تهيئة التطبيق FastAPI
@@ -183,17 +375,31 @@ def shutdown_event():
 def health_check():
     try:
         engine.neo4j_driver.verify_connectivity()
-        engine.db_conn.ping() # محاولة فحص الاتصال
-        return {"status": "ok", "services": ["Postgres", "Neo4j", "Ready"]}
+        with engine.pg.connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        return {"status": "ok", "services": ["Postgres", "Neo4j", "Ready"], "pg_pool": engine.pg.stats()}
     except Exception as e:
         logger.error(f"Health check failed: {e}")
-        return {"status": "degraded", "error": str(e)}
+        return {"status": "degraded", "error": str(e), "pg_pool": engine.pg.stats() if engine and engine.pg else None}
 
 @app.post("/run_etl_for_case")
-def run_etl(case_id: str):
-    return engine.run_correlation(case_id)
+def run_etl(case_id: str, batch: Optional[int] = None, full: bool = False):
+    """full=true يصفّر watermarks القضية ويعيد نقل كل صفوفها."""
+    return engine.run_correlation(case_id, batch, full)
+
+@app.get("/etl_status/{case_id}")
+def etl_status(case_id: str):
+    return engine.etl_status(case_id)
+
+@app.get("/analysis/{case_id}")
+def analysis(case_id: str, refresh: bool = False):
+    """كل القواعد المسجلة للقضية (من الذاكرة ما لم تصل بيانات جديدة)."""
+    return engine.evaluate_rules(case_id, use_cache=not refresh)
 
 @app.get("/get_hypotheses/{case_id}")
 def get_hypotheses(case_id: str):
-    entities = engine._extract_entities_from_postgres(case_id)
-    return engine._generate_investigator_hypotheses(case_id, entities)
+    return engine._generate_investigator_hypotheses(case_id)
+
+@app.get("/pool_stats")
+def pool_stats():
+    return {"pg": engine.pg.stats(), "neo4j_max_pool_size": NEO4J_POOL_SIZE}
@@ -1,42 +1,132 @@
 from fastapi import FastAPI, HTTPException
 import asyncpg
-from neo4j import GraphDatabase
+from neo4j import AsyncGraphDatabase
 import os
+import time
+import uuid
 import asyncio
+import contextlib
+from decimal import Decimal
 
 app = FastAPI(title="Correlation Engine - Real Production")
 
+PG_DSN = os.getenv("CORRELATION_PG_DSN", "postgresql://ffadmin:Aa100200@@@postgres:5433/ffactory_forensic")
+NEO4J_URI = os.getenv("NEO4J_URI", "bolt://neo4j:7687")
+NEO4J_USER = os.getenv("NEO4J_USER", "neo4j")
+NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD", "Forensic123!")
+# صفوف لكل دفعة UNWIND، وعدد الدفعات الجارية في Neo4j في نفس الوقت (لكل الجداول معاً)
+ETL_BATCH_ROWS = int(os.getenv("ETL_BATCH_ROWS", "5000"))
+ETL_CONCURRENCY = int(os.getenv("ETL_CONCURRENCY", "4"))
+
+PERSONS_SQL = "SELECT id, name, email, created_at FROM persons"
+FILES_SQL = "SELECT hash, filename, owner_id, size, created_at FROM files"
+OWNS_SQL = "SELECT hash, owner_id, created_at FROM files WHERE owner_id IS NOT NULL"
+
+PERSONS_CYPHER = """
+    UNWIND $rows AS r
+    MERGE (p:Person {id: r.id})
+    SET p.name = r.name,
+        p.email = r.email,
+        p.created_at = r.created_at
+"""
+FILES_CYPHER = """
+    UNWIND $rows AS r
+    MERGE (f:File {hash: r.hash})
+    SET f.filename = r.filename,
+        f.size = r.size,
+        f.created_at = r.created_at
+"""
+OWNS_CYPHER = """
+    UNWIND $rows AS r
+    MATCH (p:Person {id: r.owner_id})
+    MATCH (f:File {hash: r.hash})
+    MERGE (p)-[o:OWNS]->(f)
+    SET o.created_at = r.created_at
+"""
+
+def _plain(rec) -> dict:
+    """asyncpg Record → dict بأنواع يقبلها Neo4j (UUID → نص، Decimal → رقم)."""
+    out = {}
+    for k, v in rec.items():
+        if isinstance(v, uuid.UUID): v = str(v)
+        elif isinstance(v, Decimal): v = int(v) if v == v.to_integral_value() else float(v)
+        out[k] = v
+    return out
+
 class RealCorrelationEngine:
     def __init__(self):
         self.pg_pool = None
         self.neo4j_driver = None
-    
+        self.write_slots = None
+
     async def init_databases(self):
         """تهيئة اتصالات قواعد البيانات الحقيقية"""
         try:
             # اتصال PostgreSQL الحقيقي
-            self.pg_pool = await asyncpg.create_pool(
-                "postgresql://ffadmin:Aa100200@@@postgres:5433/ffactory_forensic"
-            )
-            
-            # اتصال Neo4j الحقيقي
-            self.neo4j_driver = GraphDatabase.driver(
-                "bolt://neo4j:7687",
-                auth=("neo4j", "Forensic123!")
-            )
-            
+            self.pg_pool = await asyncpg.create_pool(PG_DSN)
+
+            # اتصال Neo4j الحقيقي (driver غير متزامن: لا يحجب event loop)
+            self.neo4j_driver = AsyncGraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD))
+            self.write_slots = asyncio.Semaphore(ETL_CONCURRENCY)
+
             # إنشاء قيود Neo4j للحصول على أداء أفضل
-            with self.neo4j_driver.session() as session:
-                session.run("CREATE CONSTRAINT IF NOT EXISTS FOR (p:Person) REQUIRE p.id IS UNIQUE")
-                session.run("CREATE CONSTRAINT IF NOT EXISTS FOR (f:File) REQUIRE f.hash IS UNIQUE")
-                session.run("CREATE CONSTRAINT IF NOT EXISTS FOR (e:Event) REQUIRE e.event_id IS UNIQUE")
-            
+            async with self.neo4j_driver.session() as session:
+                await session.run("CREATE CONSTRAINT IF NOT EXISTS FOR (p:Person) REQUIRE p.id IS UNIQUE")
+                await session.run("CREATE CONSTRAINT IF NOT EXISTS FOR (f:File) REQUIRE f.hash IS UNIQUE")
+                await session.run("CREATE CONSTRAINT IF NOT EXISTS FOR (e:Event) REQUIRE e.event_id IS UNIQUE")
+
             print("✅ تم تهيئة محرك الترابط الحقيقي")
             return True
         except Exception as e:
             print(f"🔴 فشل تهيئة قواعد البيانات: {e}")
             return False
 
+    async def close(self):
+        if self.pg_pool: await self.pg_pool.close()
+        if self.neo4j_driver: await self.neo4j_driver.close()
+
+    async def stream(self, sql: str, batch: int):
+        """دفعات من cursor على الخادم (داخل معاملة)؛ الذاكرة = دفعة واحدة مهما كبر الجدول."""
+        async with self.pg_pool.acquire() as conn:
+            async with conn.transaction(readonly=True):
+                rows = []
+                async for rec in conn.cursor(sql, prefetch=batch):
+                    rows.append(_plain(rec))
+                    if len(rows) >= batch:
+                        yield rows
+                        rows = []
+                if rows:
+                    yield rows
+
+    async def _write(self, cypher: str, rows: list):
+        async with self.neo4j_driver.session() as session:
+            async def work(tx):
+                res = await tx.run(cypher, rows=rows)
+                await res.consume()
+            await session.execute_write(work)
+
+    async def load(self, name: str, sql: str, cypher: str, batch: int) -> dict:
+        """يبث الجدول ويرسل كل دفعة UNWIND دون انتظار سابقتها، بحد ETL_CONCURRENCY دفعة جارية."""
+        t0 = time.time()
+        n, batches, pending = 0, 0, []
+        try:
+            async with contextlib.aclosing(self.stream(sql, batch)) as pages:
+                async for rows in pages:
+                    await self.write_slots.acquire()   # ضغط عكسي: لا نقرأ أكثر مما يُكتب
+                    task = asyncio.create_task(self._write(cypher, rows))
+                    # يُحرَّر حتى لو أُلغيت المهمة قبل أن تبدأ
+                    task.add_done_callback(lambda _: self.write_slots.release())
+                    pending.append(task)
+                    n += len(rows); batches += 1
+            await asyncio.gather(*pending)
+        except BaseException:
+            for t in pending: t.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            raise
+        dt = time.time() - t0
+        return {"table": name, "rows": n, "batches": batches, "elapsed_sec": round(dt, 3),
+                "rows_per_sec": round(n / dt) if dt > 0 and n else 0}
+
 engine = RealCorrelationEngine()
 
 @app.on_event("startup")
@@ -47,6 +137,10 @@ async def startup_event():
     if not success:
         print("🔴 فشل تهيئة المحرك - سيعمل في وضع متدهور")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    await engine.close()
+
 @app.get("/health")
 async def health_check():
     """فحص صحة متقدم"""
@@ -55,11 +149,11 @@ async def health_check():
         if engine.pg_pool:
             async with engine.pg_pool.acquire() as conn:
                 await conn.fetchval("SELECT 1")
-        
+
         # فحص Neo4j
         if engine.neo4j_driver:
-            engine.neo4j_driver.verify_connectivity()
-        
+            await engine.neo4j_driver.verify_connectivity()
+
         return {
             "status": "healthy",
             "service": "correlation-engine",
@@ -75,62 +169,37 @@ async def health_check():
         }
 
 @app.post("/etl/run")
-async def run_etl():
-    """تشغيل عملية ETL حقيقية"""
+async def run_etl(batch: int = ETL_BATCH_ROWS):
+    """تشغيل عملية ETL حقيقية: الجداول كاملة، الأشخاص والملفات بالتوازي ثم علاقات OWNS."""
+    if not engine.pg_pool or not engine.neo4j_driver:
+        raise HTTPException(status_code=503, detail="قواعد البيانات غير مهيأة")
+    batch = max(1, batch)
     try:
-        # استخراج البيانات من PostgreSQL
-        async with engine.pg_pool.acquire() as conn:
-            # افتراض وجود جداول حقيقية
-            persons = await conn.fetch("""
-                SELECT id, name, email, created_at 
-                FROM persons 
-                LIMIT 100
-            """)
-            
-            files = await conn.fetch("""
-                SELECT hash, filename, owner_id, size, created_at 
-                FROM files 
-                LIMIT 100
-            """)
-        
-        # تحميل البيانات إلى Neo4j
-        with engine.neo4j_driver.session() as session:
-            # تحميل الأشخاص
-            for person in persons:
-                session.run("""
-                    MERGE (p:Person {id: $id})
-                    SET p.name = $name, 
-                        p.email = $email,
-                        p.created_at = $created_at
-                """, dict(person))
-            
-            # تحميل الملفات
-            for file in files:
-                session.run("""
-                    MERGE (f:File {hash: $hash})
-                    SET f.filename = $filename,
-                        f.size = $size,
-                        f.created_at = $created_at
-                """, dict(file))
-            
-            # إنشاء العلاقات
-            for file in files:
-                session.run("""
-                    MATCH (p:Person {id: $owner_id})
-                    MATCH (f:File {hash: $hash})
-                    MERGE (p)-[r:OWNS]->(f)
-                    SET r.created_at = $created_at
-                """, dict(file))
-        
+        t0 = time.time()
+        persons, files = await asyncio.gather(
+            engine.load("persons", PERSONS_SQL, PERSONS_CYPHER, batch),
+            engine.load("files", FILES_SQL, FILES_CYPHER, batch),
+        )
+        # العلاقات بعد اكتمال العقد: MATCH لا يفوّت مالكاً لم يُحمّل بعد
+        owns = await engine.load("owns", OWNS_SQL, OWNS_CYPHER, batch)
+        dt = time.time() - t0
+        total = persons["rows"] + files["rows"] + owns["rows"]
+
         return {
             "status": "success",
             "message": "تم تنفيذ ETL بنجاح",
             "processed": {
-                "persons": len(persons),
-                "files": len(files)
-            }
+                "persons": persons["rows"],
+                "files": files["rows"],
+                "owns": owns["rows"]
+            },
+            "stages": [persons, files, owns],
+            "elapsed_sec": round(dt, 3),
+            "rows_per_sec": round(total / dt) if dt > 0 and total else 0,
+            "batch_rows": batch,
+            "concurrency": ETL_CONCURRENCY
         }
-        
+
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"فشل ETL: {str(e)}")
 
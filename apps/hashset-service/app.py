@@ -1,42 +1,263 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
-import os, io, hashlib, requests, sqlite3, ssdeep, csv, gzip, bz2
+import os, io, hashlib, requests, sqlite3, ssdeep, csv, gzip, bz2, time, threading, queue, json, contextlib
+from concurrent.futures import ThreadPoolExecutor
+import bloom, fuzzy
 api=FastAPI()
 DB=os.getenv("NSRL_DB_PATH","/data/hashsets/nsrl.sqlite")
+HASH_CHUNK=int(os.getenv("HASH_CHUNK_BYTES",str(4*1024*1024)))
+# hashlib يحرر الـ GIL للكتل الكبيرة، فكل خوارزمية تعمل على خيط مستقل لنفس الكتلة
+hash_pool=ThreadPoolExecutor(max_workers=int(os.getenv("HASH_THREADS","4")), thread_name_prefix="hash")
+NSRL_BATCH=int(os.getenv("NSRL_BATCH_ROWS","100000"))
+# تحميل جماعي: لا fsync لكل دفعة وذاكرة تخزين كبيرة؛ WAL يبقي القراءة متاحة أثناء التحميل
+BULK_PRAGMAS=("PRAGMA synchronous=OFF","PRAGMA temp_store=MEMORY",
+              f"PRAGMA cache_size=-{int(os.getenv('NSRL_CACHE_MB','256'))*1024}")
+BLOOM_PATH=os.getenv("NSRL_BLOOM_PATH", DB+".bloom")
+BLOOM_FP=float(os.getenv("NSRL_BLOOM_FP","0.01"))
+RO_POOL_SIZE=int(os.getenv("NSRL_RO_POOL","4"))
+BATCH_LOOKUP=int(os.getenv("NSRL_LOOKUP_CHUNK","10000"))
+SQL_IN_MAX=900
+FUZZY_DB=os.getenv("FUZZY_DB_PATH", os.path.join(os.path.dirname(DB),"fuzzy.sqlite"))
 os.makedirs(os.path.dirname(DB), exist_ok=True)
+def sha1_key(s)->bytes|None:
+    """SHA-1 بصيغة hex (40 حرفاً) → مفتاح ثنائي 20 بايت."""
+    s=(s or "").strip().strip('"')
+    if len(s)!=40: return None
+    try: return bytes.fromhex(s)
+    except ValueError: return None
 def db_init():
-    con=sqlite3.connect(DB); cur=con.cursor()
-    cur.execute("CREATE TABLE IF NOT EXISTS nsrl(sha1 TEXT PRIMARY KEY)")
-    cur.execute("PRAGMA journal_mode=WAL"); con.commit(); con.close()
+    con=sqlite3.connect(DB, timeout=600, isolation_level=None); cur=con.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("BEGIN IMMEDIATE")
+    cur.execute("CREATE TABLE IF NOT EXISTS nsrl_sha1(sha1 BLOB PRIMARY KEY) WITHOUT ROWID")
+    cur.execute("""CREATE TABLE IF NOT EXISTS nsrl_load_state(url TEXT PRIMARY KEY, status TEXT,
+                   rows_done INTEGER DEFAULT 0, inserted INTEGER DEFAULT 0, resumed_from INTEGER DEFAULT 0,
+                   started_at REAL, updated_at REAL, error TEXT)""")
+    # ترحيل الجدول القديم (sha1 TEXT hex) إلى المفتاح الثنائي
+    if cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='nsrl'").fetchone():
+        rd=con.execute("SELECT sha1 FROM nsrl")
+        while rows:=rd.fetchmany(NSRL_BATCH):
+            cur.executemany("INSERT OR IGNORE INTO nsrl_sha1(sha1) VALUES(?)",
+                            [(k,) for k in map(sha1_key,(r[0] for r in rows)) if k])
+        cur.execute("DROP TABLE nsrl")
+    cur.execute("COMMIT"); con.close()
 db_init()
-class FileReq(BaseModel): file_url:str
-class LoadReq(BaseModel): nsrl_url:str
+fuzzy_index=fuzzy.FuzzyIndex(FUZZY_DB, int(os.getenv("FUZZY_MAX_CANDIDATES","1000")))
+class FileReq(BaseModel): file_url:str; fuzzy_index:bool=False
+class FuzzyItem(BaseModel): ssdeep:str; ref:str|None=None; sha256:str|None=None
+class FuzzyAddReq(BaseModel): items:list[FuzzyItem]
+# background=False (الافتراضي) يحفظ العقد القديم: الرد بعد انتهاء التحميل ويتضمن "inserted"؛
+# background=True يعيد {"started":true} فوراً والتقدم عبر /nsrl/load/status
+class LoadReq(BaseModel): nsrl_url:str; resume:bool=True; background:bool=False
+# pool اتصالات للقراءة فقط، مفتوحة طوال عمر العملية
+_ro=queue.Queue()
+for _ in range(RO_POOL_SIZE):
+    _ro.put(sqlite3.connect(f"file:{DB}?mode=ro", uri=True, check_same_thread=False))
+@contextlib.contextmanager
+def ro_conn():
+    con=_ro.get()
+    try: yield con
+    finally: _ro.put(con)
+_bloom=None; _bloom_lock=threading.Lock()
+def get_bloom():
+    """Bloom الحالي؛ يُعاد فتحه إذا استُبدل الملف (بعد تحميل جديد في أي عامل)."""
+    global _bloom
+    try: mtime=os.stat(BLOOM_PATH).st_mtime
+    except OSError: return None
+    if _bloom is None or _bloom.mtime!=mtime:
+        with _bloom_lock:
+            if _bloom is None or _bloom.mtime!=mtime:
+                _bloom=bloom.BloomFilter(BLOOM_PATH)
+    return _bloom
+def rebuild_bloom()->dict:
+    con=sqlite3.connect(DB, timeout=600)
+    try:
+        n=con.execute("SELECT count(*) FROM nsrl_sha1").fetchone()[0]
+        cur=con.execute("SELECT sha1 FROM nsrl_sha1")
+        def batches():
+            while rows:=cur.fetchmany(NSRL_BATCH): yield [r[0] for r in rows]
+        return bloom.build(BLOOM_PATH, n, batches(), BLOOM_FP)
+    finally: con.close()
+def lookup(keys:list[bytes])->set[bytes]:
+    """المفاتيح الموجودة في NSRL: Bloom يستبعد معظم المجهول، والبقية تُفحص في SQLite بـ IN."""
+    bf=get_bloom()
+    cand=[k for k,m in zip(keys, bf.might_contain(keys)) if m] if bf else keys
+    found=set()
+    with ro_conn() as con:
+        for i in range(0, len(cand), SQL_IN_MAX):
+            part=cand[i:i+SQL_IN_MAX]
+            found.update(r[0] for r in con.execute(
+                f"SELECT sha1 FROM nsrl_sha1 WHERE sha1 IN ({','.join('?'*len(part))})", part))
+    return found
 @api.get("/health") 
-def health(): return {"status":"ok","nsrl_db":os.path.exists(DB)}
-def fetch(url)->bytes:
-    r=requests.get(url, timeout=600); r.raise_for_status(); return r.content
+def health():
+    bf=get_bloom()
+    return {"status":"ok","nsrl_db":os.path.exists(DB),"bloom":bf.info() if bf else None,
+            "ro_pool":{"size":RO_POOL_SIZE,"idle":_ro.qsize()},"fuzzy_corpus":fuzzy_index.count()}
+def fetch_chunks(url, size=HASH_CHUNK):
+    with requests.get(url, timeout=600, stream=True) as r:
+        r.raise_for_status()
+        yield from r.iter_content(size)
+def multi_hash(chunks)->dict:
+    """تمريرة واحدة: كل كتلة تُغذّى لـ md5/sha1/sha256/ssdeep بالتوازي، وقراءة
+    الكتلة التالية تتداخل مع حساب الحالية؛ الذاكرة ثابتة (كتلتان على الأكثر)."""
+    hs={"md5":hashlib.md5(),"sha1":hashlib.sha1(),"sha256":hashlib.sha256(),"ssdeep":ssdeep.Hash()}
+    pending=[]; size=0
+    for b in chunks:
+        if not b: continue
+        for f in pending: f.result()
+        pending=[hash_pool.submit(h.update, b) for h in hs.values()]
+        size+=len(b)
+    for f in pending: f.result()
+    out={k:h.hexdigest() for k,h in hs.items() if k!="ssdeep"}
+    out["ssdeep"]=hs["ssdeep"].digest(); out["size_bytes"]=size
+    return out
 @api.post("/hash")
 def do_hash(req:FileReq):
-    b=fetch(req.file_url)
-    return {"md5":hashlib.md5(b).hexdigest(),"sha1":hashlib.sha1(b).hexdigest(),
-            "sha256":hashlib.sha256(b).hexdigest(),"ssdeep":ssdeep.hash(b)}
-@api.post("/nsrl/load")
-def nsrl_load(req:LoadReq):
-    raw=fetch(req.nsrl_url)
-    if req.nsrl_url.endswith(".gz"): raw=gzip.decompress(raw)
-    if req.nsrl_url.endswith(".bz2"): raw=bz2.decompress(raw)
-    con=sqlite3.connect(DB); cur=con.cursor(); cur.execute("BEGIN")
-    ins=0
+    t0=time.time(); out=multi_hash(fetch_chunks(req.file_url)); dt=time.time()-t0
+    out["elapsed_sec"]=round(dt,3); out["mb_per_sec"]=round(out["size_bytes"]/1048576/dt,1) if dt else None
+    if req.fuzzy_index: out["fuzzy_indexed"]=bool(fuzzy_index.add_many([(out["ssdeep"],req.file_url,out["sha256"])]))
+    return out
+def nsrl_rows(url):
+    """تدفق: تنزيل → فك ضغط gzip/bz2 → CSV دون تحميل الأرشيف في الذاكرة."""
+    r=requests.get(url, timeout=600, stream=True); r.raise_for_status()
+    r.raw.decode_content=True
+    raw=r.raw
+    if url.endswith(".gz"): raw=gzip.GzipFile(fileobj=raw)
+    elif url.endswith(".bz2"): raw=bz2.BZ2File(raw)
+    try:
+        yield from csv.DictReader(io.TextIOWrapper(raw, encoding="utf-8", errors="ignore", newline=""))
+    finally: r.close()
+def load_state(url)->dict|None:
+    con=sqlite3.connect(DB, timeout=30)
     try:
-        for row in csv.DictReader(io.StringIO(raw.decode(errors="ignore"))):
-            sha=(row.get("SHA-1") or row.get("sha1") or row.get("SHA1") or "").strip().upper()
-            if len(sha)==40:
-                try: cur.execute("INSERT OR IGNORE INTO nsrl(sha1) VALUES(?)",(sha,)); ins+=1
-                except Exception: pass
-        con.commit()
+        row=con.execute("""SELECT url,status,rows_done,inserted,resumed_from,started_at,updated_at,error
+                           FROM nsrl_load_state WHERE url=?""",(url,)).fetchone()
     finally: con.close()
-    return {"inserted":ins}
+    if not row: return None
+    st=dict(zip(("url","status","rows_done","inserted","resumed_from","started_at","updated_at","error"),row))
+    dt=(st["updated_at"] or 0)-(st["started_at"] or 0)
+    st["rows_per_sec"]=round((st["rows_done"]-st["resumed_from"])/dt) if dt>0 else None
+    return st
+def nsrl_bulk_load(url, resume=True)->dict:
+    """تحميل قابل للاستئناف: الدفعات (NSRL_BATCH_ROWS) تُكتب مع عدّاد التقدم في نفس
+    المعاملة، فعند الاستئناف نتخطى الصفوف المنجزة (INSERT OR IGNORE يجعل التكرار آمناً)."""
+    con=sqlite3.connect(DB, timeout=600, isolation_level=None)
+    for p in BULK_PRAGMAS: con.execute(p)
+    prev=con.execute("SELECT rows_done,inserted FROM nsrl_load_state WHERE url=? AND status!='done'",(url,)).fetchone()
+    skip,ins=(prev if resume and prev else (0,0))
+    t0=time.time()
+    con.execute("""INSERT INTO nsrl_load_state(url,status,rows_done,inserted,resumed_from,started_at,updated_at)
+                   VALUES(?,?,?,?,?,?,?)
+                   ON CONFLICT(url) DO UPDATE SET status='running', rows_done=excluded.rows_done, inserted=excluded.inserted,
+                   resumed_from=excluded.resumed_from, started_at=excluded.started_at,
+                   updated_at=excluded.updated_at, error=NULL""",
+                (url,"running",skip,ins,skip,t0,t0))
+    n=0; batch=[]
+    def flush():
+        nonlocal ins
+        batch.sort()  # إدراج مرتب → صفحات B-tree متجاورة
+        con.execute("BEGIN")
+        ins+=max(0, con.executemany("INSERT OR IGNORE INTO nsrl_sha1(sha1) VALUES(?)", batch).rowcount)
+        con.execute("UPDATE nsrl_load_state SET status=?, rows_done=?, inserted=?, updated_at=? WHERE url=?",
+                    ("running",n,ins,time.time(),url))
+        con.execute("COMMIT"); batch.clear()
+    try:
+        for row in nsrl_rows(url):
+            n+=1
+            if n<=skip: continue
+            k=sha1_key(row.get("SHA-1") or row.get("sha1") or row.get("SHA1"))
+            if k: batch.append((k,))
+            if len(batch)>=NSRL_BATCH: flush()
+        flush()
+        con.execute("UPDATE nsrl_load_state SET status='bloom', updated_at=? WHERE url=?",(time.time(),url))
+        rebuild_bloom()
+        con.execute("UPDATE nsrl_load_state SET status='done', updated_at=? WHERE url=?",(time.time(),url))
+    except Exception as e:
+        if con.in_transaction: con.execute("ROLLBACK")
+        con.execute("UPDATE nsrl_load_state SET status='failed', error=?, updated_at=? WHERE url=?",(str(e)[:2000],time.time(),url))
+        raise
+    finally: con.close()
+    return load_state(url)
+@api.post("/nsrl/load")
+def nsrl_load(req:LoadReq):
+    st=load_state(req.nsrl_url)
+    if st and st["status"]=="running" and time.time()-(st["updated_at"] or 0)<300:
+        raise HTTPException(409, "load already running")
+    if not req.background:
+        return nsrl_bulk_load(req.nsrl_url, req.resume)
+    threading.Thread(target=nsrl_bulk_load, args=(req.nsrl_url, req.resume), daemon=True).start()
+    return {"started":True,"url":req.nsrl_url,"resume":req.resume}
+@api.get("/nsrl/load/status")
+def nsrl_load_status(nsrl_url:str):
+    st=load_state(nsrl_url)
+    if not st: raise HTTPException(404, "no load recorded for this url")
+    return st
 @api.get("/nsrl/check")
 def nsrl_check(sha1:str):
-    con=sqlite3.connect(DB); cur=con.execute("SELECT 1 FROM nsrl WHERE sha1=? LIMIT 1;",(sha1.upper(),))
-    ok = cur.fetchone() is not None; con.close(); return {"present":ok}
+    k=sha1_key(sha1)
+    if not k: raise HTTPException(422, "sha1 must be 40 hex chars")
+    return {"present":k in lookup([k])}
+def _verdicts(hashes:list[str])->str:
+    keys=[sha1_key(h) for h in hashes]
+    found=lookup([k for k in keys if k])
+    out=[]
+    for h,k in zip(hashes,keys):
+        if k: out.append(json.dumps({"sha1":h,"present":k in found}))
+        else: out.append(json.dumps({"sha1":h,"error":"invalid"}))
+    return "\n".join(out)+"\n"
+@api.post("/nsrl/check_batch")
+async def nsrl_check_batch(request:Request):
+    """فحص آلاف الـ SHA-1 دفعة واحدة: JSON {"hashes":[...]} أو نص سطر لكل hash.
+    الأحكام تُبث NDJSON على دفعات NSRL_LOOKUP_CHUNK.
+    الجسم يُقرأ قبل بدء الاستجابة لأن StreamingResponse يستهلك receive() بنفسه."""
+    if request.headers.get("content-type","").startswith("application/json"):
+        body=await request.json()
+        hashes=[str(h).strip() for h in ((body.get("hashes") if isinstance(body,dict) else body) or [])]
+    else:
+        hashes=(await request.body()).decode(errors="ignore").split()
+    hashes=[h for h in hashes if h]
+    async def gen():
+        for i in range(0, len(hashes), BATCH_LOOKUP):
+            yield await run_in_threadpool(_verdicts, hashes[i:i+BATCH_LOOKUP])
+    return StreamingResponse(gen(), media_type="application/x-ndjson")
+@api.post("/nsrl/bloom/rebuild")
+def nsrl_bloom_rebuild():
+    return rebuild_bloom()
+@api.get("/nsrl/bench")
+def nsrl_bench(n:int=100000, known_ratio:float=0.01):
+    """قياس lookups/sec: مزيج من مفاتيح عشوائية (مجهولة) ونسبة known_ratio من مفاتيح موجودة."""
+    n=max(1,min(n,5_000_000))
+    with ro_conn() as con:
+        known=[r[0] for r in con.execute("SELECT sha1 FROM nsrl_sha1 LIMIT ?",(int(n*known_ratio),))]
+    keys=known+[os.urandom(20) for _ in range(n-len(known))]
+    res={}
+    t0=time.perf_counter(); hits=0
+    for i in range(0,len(keys),BATCH_LOOKUP): hits+=len(lookup(keys[i:i+BATCH_LOOKUP]))
+    dt=time.perf_counter()-t0
+    res["bloom+sqlite"]={"lookups_per_sec":round(len(keys)/dt),"hits":hits,"bloom":get_bloom() is not None}
+    sample=keys[:min(len(keys),20000)]
+    t0=time.perf_counter()
+    with ro_conn() as con:
+        for k in sample: con.execute("SELECT 1 FROM nsrl_sha1 WHERE sha1=? LIMIT 1",(k,)).fetchone()
+    dt=time.perf_counter()-t0
+    res["sqlite_point_queries"]={"lookups_per_sec":round(len(sample)/dt)}
+    return {"n":len(keys),"known":len(known),**res}
+@api.post("/fuzzy/add")
+def fuzzy_add(req:FuzzyAddReq):
+    """إضافة digests ssdeep إلى المجموعة (المكرر يُتجاهل)."""
+    t0=time.time()
+    n=fuzzy_index.add_many([(i.ssdeep,i.ref,i.sha256) for i in req.items])
+    return {"added":n,"skipped":len(req.items)-n,"elapsed_sec":round(time.time()-t0,3)}
+@api.get("/fuzzy/search")
+def fuzzy_search(ssdeep:str, threshold:int=50, limit:int=20):
+    """near-duplicates بدرجة ssdeep.compare >= threshold؛ المقارنة على المرشحين من فهرس 7-gram فقط."""
+    try: out=fuzzy_index.search(ssdeep, max(0,min(threshold,100)), max(1,limit))
+    except ValueError: raise HTTPException(422, "ssdeep must be blocksize:hash1:hash2")
+    return {"corpus":fuzzy_index.count(),**out}
+@api.get("/fuzzy/bench")
+def fuzzy_bench(queries:int=200, threshold:int=50):
+    """زمن الاستعلام (p50/p95/p99) على المجموعة الحالية."""
+    return fuzzy_index.bench(max(1,min(queries,10000)), threshold)
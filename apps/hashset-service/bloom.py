@@ -0,0 +1,68 @@
+"""Bloom filter على ملف مُعيَّن في الذاكرة (mmap) لمفاتيح SHA-1 الثنائية.
+
+مفاتيح SHA-1 موزعة بانتظام أصلاً، فتُشتق مواقع البتات k مباشرة من بايتات
+المفتاح (double hashing: h1 + i*h2) دون أي hash إضافي. البناء والفحص
+متجهان بـ numpy على دفعات.
+
+صيغة الملف: ترويسة (magic, m_bits, k, n) ثم مصفوفة البتات.
+"""
+import os, math, struct
+import numpy as np
+
+MAGIC = b"FFBLOOM1"
+HDR = struct.Struct("<8sQQQ")
+
+def params(n: int, fp: float):
+    n = max(1, n)
+    m = max(1 << 16, int(-n * math.log(fp) / (math.log(2) ** 2)))
+    m = (m + 63) // 64 * 64
+    k = max(1, round(m / n * math.log(2)))
+    return m, k
+
+def _as_array(keys):
+    if isinstance(keys, np.ndarray): return keys
+    return np.frombuffer(b"".join(keys), dtype=np.uint8).reshape(-1, 20)
+
+def _positions(arr, m, k):
+    h1 = arr[:, 0:8].copy().view("<u8").ravel()
+    h2 = arr[:, 8:16].copy().view("<u8").ravel() | np.uint64(1)
+    i = np.arange(k, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        return (h1[:, None] + i[None, :] * h2[:, None]) % np.uint64(m)
+
+def build(path: str, n: int, batches, fp: float = 0.01) -> dict:
+    """يبني الملف من دفعات مفاتيح (قوائم bytes بطول 20) ثم يستبدله ذرياً."""
+    m, k = params(n, fp)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(HDR.pack(MAGIC, m, k, n)); f.truncate(HDR.size + m // 8)
+    bits = np.memmap(tmp, dtype=np.uint8, mode="r+", offset=HDR.size, shape=(m // 8,))
+    count = 0
+    for keys in batches:
+        if not keys: continue
+        pos = _positions(_as_array(keys), m, k).ravel()
+        np.bitwise_or.at(bits, (pos >> np.uint64(3)).astype(np.int64),
+                         np.left_shift(1, (pos & np.uint64(7)).astype(np.uint8)).astype(np.uint8))
+        count += len(keys)
+    bits.flush(); del bits
+    os.replace(tmp, path)
+    return {"m_bits": m, "k": k, "n": count, "size_mb": round(m / 8 / 1048576, 1), "fp_target": fp}
+
+class BloomFilter:
+    def __init__(self, path: str):
+        self.path = path
+        self.mtime = os.stat(path).st_mtime
+        with open(path, "rb") as f:
+            magic, self.m, self.k, self.n = HDR.unpack(f.read(HDR.size))
+        if magic != MAGIC: raise ValueError("not a bloom file")
+        self.bits = np.memmap(path, dtype=np.uint8, mode="r", offset=HDR.size, shape=(self.m // 8,))
+
+    def might_contain(self, keys) -> np.ndarray:
+        """مصفوفة bool: False = غير موجود بالتأكيد، True = ربما (يجب فحص SQLite)."""
+        if len(keys) == 0: return np.zeros(0, dtype=bool)
+        pos = _positions(_as_array(keys), self.m, self.k)
+        byte = self.bits[(pos >> np.uint64(3)).astype(np.int64)]
+        return ((byte >> (pos & np.uint64(7)).astype(np.uint8)) & 1).all(axis=1)
+
+    def info(self) -> dict:
+        return {"m_bits": self.m, "k": self.k, "n": self.n, "size_mb": round(self.m / 8 / 1048576, 1)}
@@ -0,0 +1,166 @@
+"""فهرس تشابه ssdeep: بدل مقارنة digest جديد بكل digest مخزّن، نفهرس كل digest
+بمقاطع 7-gram من سلسلتيه مع حجم الكتلة، ونشغّل ssdeep.compare على القائمة
+القصيرة التي تشارك الاستعلام في 7-gram واحد على الأقل فقط.
+
+هذا لا يفقد نتائج: ssdeep.compare يعيد 0 ما لم تكن أحجام الكتل متساوية أو
+بنسبة 2 وتوجد سلسلة مشتركة بطول 7. لذلك:
+  digest مخزّن (B, a1, a2) يُفهرس تحت (B, grams(a1)) و (2B, grams(a2))
+  استعلام (b, q1, q2) يبحث تحت (b, grams(q1)) و (2b, grams(q2))
+
+الـ 7-gram (أحرف base64) يُخزَّن كعدد صحيح 56 بت بلا تصادمات.
+"""
+import re, sys, time, random, sqlite3, threading
+import ssdeep
+
+NGRAM = 7
+_RUNS = re.compile(r"(.)\1{3,}")
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS fuzzy(id INTEGER PRIMARY KEY, ssdeep TEXT NOT NULL UNIQUE,
+       chunksize INTEGER NOT NULL, ref TEXT, sha256 TEXT, added_at REAL)""",
+    """CREATE TABLE IF NOT EXISTS fuzzy_ngram(chunksize INTEGER NOT NULL, ngram INTEGER NOT NULL, id INTEGER NOT NULL,
+       PRIMARY KEY(chunksize, ngram, id)) WITHOUT ROWID""",
+)
+
+def parse(digest: str):
+    """'bs:s1:s2' → (bs, s1, s2) بعد طي التكرارات (>3) كما يفعل ssdeep قبل المقارنة."""
+    bs, s1, s2 = digest.strip().split(":", 2)
+    s2 = s2.split(",", 1)[0]   # صيغة ssdeep -c تنتهي بـ ,"filename"
+    return int(bs), _RUNS.sub(r"\1\1\1", s1), _RUNS.sub(r"\1\1\1", s2)
+
+def grams(s: str):
+    b = s.encode()
+    return {int.from_bytes(b[i:i + NGRAM], "big") for i in range(len(b) - NGRAM + 1)}
+
+def index_keys(digest: str):
+    """[(chunksize, ngram)] التي يُفهرس تحتها الـ digest (ويُبحث بها عند الاستعلام)."""
+    bs, s1, s2 = parse(digest)
+    return [(bs, g) for g in grams(s1)] + [(bs * 2, g) for g in grams(s2)]
+
+class FuzzyIndex:
+    def __init__(self, path: str, max_candidates: int = 1000):
+        self.path = path
+        self.max_candidates = max_candidates
+        self._wlock = threading.Lock()
+        con = self._connect()
+        con.execute("PRAGMA journal_mode=WAL")
+        for q in SCHEMA: con.execute(q)
+        con.commit(); con.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def add_many(self, items, bulk: bool = False) -> int:
+        """items: (ssdeep, ref, sha256)؛ الـ digests المكررة أو غير الصالحة تُتجاهل."""
+        added = 0
+        with self._wlock:
+            con = self._connect()
+            try:
+                con.execute(f"PRAGMA synchronous={'OFF' if bulk else 'NORMAL'}")
+                ngrams = []
+                for digest, ref, sha256 in items:
+                    try: bs, keys = parse(digest)[0], index_keys(digest)
+                    except ValueError: continue
+                    cur = con.execute("INSERT OR IGNORE INTO fuzzy(ssdeep,chunksize,ref,sha256,added_at) VALUES(?,?,?,?,?)",
+                                      (digest, bs, ref, sha256, time.time()))
+                    if not cur.rowcount: continue
+                    ngrams += [(c, g, cur.lastrowid) for c, g in keys]
+                    added += 1
+                ngrams.sort()  # إدراج مرتب → صفحات B-tree متجاورة
+                con.executemany("INSERT OR IGNORE INTO fuzzy_ngram(chunksize,ngram,id) VALUES(?,?,?)", ngrams)
+                con.commit()
+            finally: con.close()
+        return added
+
+    def candidates(self, con, digest: str) -> tuple[list[int], int]:
+        """(المعرفات المرشحة، عددها قبل القص). الترتيب بعدد الـ 7-grams المشتركة تنازلياً (ثم id)
+        قبل القص بـ max_candidates، فالـ 7-grams الشائعة لا تُسقط الأقرب. الـ digest المطابق حرفياً
+        يتصدر دائماً: أجزاء أقصر من 7 لا تنتج grams، لكن ssdeep.compare يعطي المتطابقين 100."""
+        by_cs = {}
+        for c, g in index_keys(digest): by_cs.setdefault(c, []).append(g)
+        shared = {}
+        for c, gs in by_cs.items():
+            for fid, n in con.execute(
+                    f"SELECT id, count(*) FROM fuzzy_ngram WHERE chunksize=? AND ngram IN ({','.join('?' * len(gs))}) GROUP BY id",
+                    [c, *gs]):
+                shared[fid] = shared.get(fid, 0) + n
+        exact = con.execute("SELECT id FROM fuzzy WHERE ssdeep=?", (digest.strip(),)).fetchone()
+        if exact: shared[exact[0]] = float("inf")
+        ranked = sorted(shared, key=lambda fid: (-shared[fid], fid))
+        return ranked[:self.max_candidates], len(ranked)
+
+    def search(self, digest: str, threshold: int = 50, limit: int = 20) -> dict:
+        t0 = time.perf_counter()
+        con = self._connect()
+        try:
+            cand, total = self.candidates(con, digest)
+            rows = []
+            for i in range(0, len(cand), 900):
+                part = cand[i:i + 900]
+                rows += con.execute(f"SELECT id, ssdeep, ref, sha256 FROM fuzzy WHERE id IN ({','.join('?' * len(part))})",
+                                    part).fetchall()
+        finally: con.close()
+        hits = []
+        for fid, d, ref, sha in rows:
+            score = ssdeep.compare(digest, d)
+            if score >= threshold:
+                hits.append({"id": fid, "ssdeep": d, "ref": ref, "sha256": sha, "score": score})
+        hits.sort(key=lambda h: h["score"], reverse=True)
+        return {"hits": hits[:limit], "candidates": len(cand), "candidates_total": total,
+                "capped": total > len(cand),
+                "latency_ms": round((time.perf_counter() - t0) * 1000, 2)}
+
+    def count(self) -> int:
+        con = self._connect()
+        try: return con.execute("SELECT count(*) FROM fuzzy").fetchone()[0]
+        finally: con.close()
+
+    def sample(self, n: int) -> list[str]:
+        con = self._connect()
+        try:
+            hi = con.execute("SELECT max(id) FROM fuzzy").fetchone()[0] or 0
+            ids = random.sample(range(1, hi + 1), min(n, hi))
+            out = []
+            for i in range(0, len(ids), 900):
+                part = ids[i:i + 900]
+                out += [r[0] for r in con.execute(f"SELECT ssdeep FROM fuzzy WHERE id IN ({','.join('?' * len(part))})", part)]
+            return out
+        finally: con.close()
+
+    def bench(self, queries: int = 200, threshold: int = 50) -> dict:
+        """زمن الاستعلام على المجموعة الحالية: digests عيّنة مع تعديل بسيط (near-duplicates)."""
+        qs = [_mutate(d) for d in self.sample(queries)]
+        lat, found, cand = [], 0, 0
+        for q in qs:
+            r = self.search(q, threshold, limit=1)
+            lat.append(r["latency_ms"]); cand += r["candidates"]; found += bool(r["hits"])
+        lat.sort()
+        pct = lambda p: lat[min(len(lat) - 1, int(p * len(lat)))] if lat else None
+        return {"corpus": self.count(), "queries": len(qs), "found": found,
+                "avg_candidates": round(cand / len(qs), 1) if qs else None,
+                "latency_ms": {"p50": pct(.5), "p95": pct(.95), "p99": pct(.99), "max": lat[-1] if lat else None}}
+
+_B64 = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+
+def _mutate(digest: str, edits: int = 3) -> str:
+    bs, s1, s2 = digest.split(":", 2)
+    s1 = list(s1)
+    for _ in range(min(edits, len(s1) // NGRAM)):
+        s1[random.randrange(len(s1))] = random.choice(_B64)
+    return f"{bs}:{''.join(s1)}:{s2}"
+
+def _synthetic(n: int):
+    for _ in range(n):
+        bs = 3 * 2 ** random.randint(4, 12)
+        yield (f"{bs}:{''.join(random.choices(_B64, k=random.randint(40, 64)))}"
+               f":{''.join(random.choices(_B64, k=random.randint(20, 32)))}", None, None)
+
+if __name__ == "__main__":
+    # python fuzzy.py [n_digests] [db_path] — يبني مجموعة اصطناعية ثم يقيس زمن الاستعلام
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    path = sys.argv[2] if len(sys.argv) > 2 else "/tmp/fuzzy-bench.sqlite"
+    idx = FuzzyIndex(path)
+    t0 = time.time(); gen = _synthetic(max(0, n - idx.count()))
+    while batch := [x for _, x in zip(range(50_000), gen)]:
+        idx.add_many(batch, bulk=True)
+    print({"load_sec": round(time.time() - t0, 1), **idx.bench()})
@@ -0,0 +1,173 @@
+"""طابور مهام دائم في Postgres لـ ingest-worker.
+
+المهام تُحجز بـ SELECT ... FOR UPDATE SKIP LOCKED مع مهلة حجز (lease)، فإذا
+مات عامل أثناء التنفيذ تعود المهمة للطابور بعد انتهاء المهلة. مجموعة من
+العمليات (INGEST_WORKERS) تسحب المهام، وكل مرحلة مكلفة (ffmpeg / asr / graph)
+محدودة بسيمافور مشترك بين العمليات.
+"""
+import os, json, time, socket, contextlib, multiprocessing as mp
+import psycopg2.extras
+import resources
+
+def env(k, d=None): return os.getenv(k, d)
+
+WORKERS      = int(env("INGEST_WORKERS", str(os.cpu_count() or 2)))
+POLL_SEC     = float(env("INGEST_POLL_SEC", "1.0"))
+LEASE_SEC    = int(env("INGEST_LEASE_SEC", "900"))
+MAX_ATTEMPTS = int(env("INGEST_MAX_ATTEMPTS", "3"))
+STAGE_LIMITS = {
+    "ffmpeg": int(env("FFMPEG_CONCURRENCY", "2")),
+    "asr":    int(env("ASR_CONCURRENCY", "1")),
+    "graph":  int(env("GRAPH_CONCURRENCY", "2")),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ingest_jobs(
+  id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+  status TEXT NOT NULL DEFAULT 'queued',   -- queued | running | done | failed
+  stage TEXT,
+  progress REAL DEFAULT 0,
+  payload JSONB NOT NULL,
+  result JSONB,
+  error TEXT,
+  attempts INT DEFAULT 0,
+  locked_by TEXT,
+  locked_until TIMESTAMPTZ,
+  created_at TIMESTAMPTZ DEFAULT now(),
+  updated_at TIMESTAMPTZ DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS ingest_jobs_status_idx ON ingest_jobs(status, created_at);
+"""
+
+_procs = []
+_sems = {}
+
+@contextlib.contextmanager
+def _cursor():
+    with resources.pg() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            yield cur
+
+def ensure_schema():
+    with _cursor() as cur:
+        cur.execute('CREATE EXTENSION IF NOT EXISTS "uuid-ossp"')
+        cur.execute(SCHEMA)
+
+def enqueue(payload: dict) -> str:
+    with _cursor() as cur:
+        cur.execute("INSERT INTO ingest_jobs(payload) VALUES (%s) RETURNING id", (json.dumps(payload),))
+        return str(cur.fetchone()["id"])
+
+def _row(r):
+    if not r: return None
+    r = dict(r); r["id"] = str(r["id"])
+    for k in ("created_at", "updated_at", "locked_until"):
+        if r.get(k): r[k] = r[k].isoformat()
+    return r
+
+def get_job(job_id: str):
+    with _cursor() as cur:
+        cur.execute("""SELECT id,status,stage,progress,payload,result,error,attempts,created_at,updated_at
+                       FROM ingest_jobs WHERE id=%s""", (job_id,))
+        return _row(cur.fetchone())
+
+def list_jobs(status: str | None = None, limit: int = 50):
+    with _cursor() as cur:
+        q = "SELECT id,status,stage,progress,attempts,created_at,updated_at FROM ingest_jobs"
+        if status: q += " WHERE status=%s"
+        q += " ORDER BY created_at DESC LIMIT %s"
+        cur.execute(q, (status, limit) if status else (limit,))
+        return [_row(r) for r in cur.fetchall()]
+
+def counts() -> dict:
+    with _cursor() as cur:
+        cur.execute("SELECT status, count(*) AS n FROM ingest_jobs GROUP BY status")
+        return {r["status"]: r["n"] for r in cur.fetchall()}
+
+def dedup_stats() -> dict:
+    """نسبة الإصابة/الإخفاق لذاكرة المحتوى من نتائج المهام المنتهية (مشتركة بين كل العمال)."""
+    with _cursor() as cur:
+        cur.execute("""SELECT count(*) FILTER (WHERE result->>'dedup'='hit') AS hits,
+                              count(*) FILTER (WHERE result->>'dedup'='miss') AS misses
+                       FROM ingest_jobs WHERE status='done'""")
+        r = cur.fetchone()
+    total = r["hits"] + r["misses"]
+    return {"hits": r["hits"], "misses": r["misses"], "hit_ratio": round(r["hits"] / total, 4) if total else None}
+
+def _claim(worker_id: str):
+    with _cursor() as cur:
+        # مهام انتهت مهلتها واستنفدت المحاولات → failed
+        cur.execute("""UPDATE ingest_jobs SET status='failed', error=coalesce(error,'lease expired'), updated_at=now()
+                       WHERE status='running' AND locked_until<now() AND attempts>=%s""", (MAX_ATTEMPTS,))
+        cur.execute("""
+        UPDATE ingest_jobs SET status='running', attempts=attempts+1, locked_by=%s,
+               locked_until=now()+make_interval(secs=>%s), updated_at=now()
+        WHERE id=(SELECT id FROM ingest_jobs
+                  WHERE status='queued' OR (status='running' AND locked_until<now() AND attempts<%s)
+                  ORDER BY created_at FOR UPDATE SKIP LOCKED LIMIT 1)
+        RETURNING id, payload, attempts""", (worker_id, LEASE_SEC, MAX_ATTEMPTS))
+        return cur.fetchone()
+
+def set_progress(job_id, stage: str, progress: float):
+    with _cursor() as cur:
+        cur.execute("""UPDATE ingest_jobs SET stage=%s, progress=%s, updated_at=now(),
+                       locked_until=now()+make_interval(secs=>%s) WHERE id=%s""",
+                    (stage, progress, LEASE_SEC, job_id))
+
+def _finish(job_id, result: dict):
+    with _cursor() as cur:
+        cur.execute("""UPDATE ingest_jobs SET status='done', stage='done', progress=1, result=%s,
+                       error=NULL, locked_until=NULL, updated_at=now() WHERE id=%s""",
+                    (json.dumps(result, default=str), job_id))
+
+def _fail(job_id, attempts: int, err: str):
+    status = "failed" if attempts >= MAX_ATTEMPTS else "queued"
+    with _cursor() as cur:
+        cur.execute("""UPDATE ingest_jobs SET status=%s, error=%s, locked_until=NULL, updated_at=now()
+                       WHERE id=%s""", (status, err[:2000], job_id))
+
+@contextlib.contextmanager
+def stage(name: str):
+    """حد التزامن لمرحلة مكلفة عبر كل عمليات العمال (لا شيء خارج المجموعة)."""
+    sem = _sems.get(name)
+    if sem is None:
+        yield; return
+    with sem:
+        yield
+
+def _loop(handler, sems):
+    global _sems
+    _sems = sems
+    resources.init()
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    while True:
+        try:
+            job = _claim(worker_id)
+        except Exception as e:
+            print(f"[ingest-worker] claim failed: {e}", flush=True)
+            time.sleep(POLL_SEC * 5); continue
+        if not job:
+            time.sleep(POLL_SEC); continue
+        jid = job["id"]
+        try:
+            result = handler(job["payload"], lambda st, p: set_progress(jid, st, p))
+            _finish(jid, result)
+        except Exception as e:
+            _fail(jid, job["attempts"], f"{type(e).__name__}: {e}")
+
+def start(handler, workers: int = WORKERS):
+    global _sems
+    _sems = {k: mp.BoundedSemaphore(max(1, n)) for k, n in STAGE_LIMITS.items()}
+    for _ in range(max(0, workers)):
+        p = mp.Process(target=_loop, args=(handler, _sems), daemon=True)
+        p.start(); _procs.append(p)
+
+def stop():
+    for p in _procs:
+        if p.is_alive(): p.terminate()
+    for p in _procs: p.join(timeout=5)
+    _procs.clear()
+
+def stats() -> dict:
+    return {"workers": len(_procs), "alive": sum(p.is_alive() for p in _procs),
+            "stage_limits": STAGE_LIMITS, "jobs": counts()}
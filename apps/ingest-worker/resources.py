@@ -0,0 +1,141 @@
+"""موارد مشتركة على مستوى العملية: pool لـ Postgres، driver واحد لـ Neo4j،
+وعميل HTTP بـ keep-alive لـ ASR و neural-core.
+
+كل عملية (الـ API وكل عامل من jobqueue) تبني مواردها الخاصة: بعد fork يُعاد
+البناء تلقائياً عند أول استخدام، ولا تُغلق اتصالات الأب الموروثة ولا تُحرَّر
+(تبقى في _inherited) لأن إغلاقها من الابن يقطعها عن الأب أيضاً.
+"""
+import os, threading, contextlib, multiprocessing as mp
+import httpx
+from psycopg2.pool import ThreadedConnectionPool
+from neo4j import GraphDatabase, basic_auth
+
+def env(k, d=None): return os.getenv(k, d)
+
+DB_URL          = env("DB_URL")
+NEO4J_URI       = env("NEO4J_URI","bolt://neo4j:7687")
+NEO4J_AUTH      = env("NEO4J_AUTH","none")
+PG_POOL_MIN     = int(env("PG_POOL_MIN","1"))
+PG_POOL_MAX     = int(env("PG_POOL_MAX","8"))
+NEO4J_POOL_SIZE = int(env("NEO4J_POOL_SIZE","16"))
+HTTP_MAX_CONN   = int(env("HTTP_MAX_CONNECTIONS","16"))
+HTTP_KEEPALIVE  = int(env("HTTP_MAX_KEEPALIVE","8"))
+
+_lock = threading.Lock()
+_pid = None
+_pg = _pg_sem = _neo = _http = None
+# موارد الأب الموروثة بعد fork: تبقى مرجعاً حياً في الابن، لأن تحريرها يستدعي PQfinish
+# (رسالة Terminate على المقبس المشترك) فيقطع اتصال الأب الخامل
+_inherited = []
+# عدادات كل العمليات في ذاكرة مشتركة تُنشأ عند الاستيراد (قبل fork): لكل عملية خانة بـ pid،
+# فالـ API (/health) يجمع حركة عمال jobqueue حيث تجري كل الاستدعاءات فعلاً. قفل المصفوفة
+# يحمي الزيادة من الخيوط والعمليات معاً
+STATS_SLOTS = int(env("RESOURCE_STATS_SLOTS","64"))
+FIELDS = ("pid", "pg_checkouts", "pg_waits", "pg_in_use", "http_requests")
+_shared = mp.Array("q", STATS_SLOTS * len(FIELDS))
+_slot = None
+
+def _neo4j_auth():
+    if not NEO4J_AUTH or NEO4J_AUTH.lower() == "none": return None
+    sep = "/" if "/" in NEO4J_AUTH else ":"
+    user, pw = NEO4J_AUTH.split(sep, 1)
+    return basic_auth(user, pw)
+
+def _alive(pid):
+    try: os.kill(pid, 0); return True
+    except OSError: return False
+
+def _claim_slot():
+    """خانة لهذه العملية: فارغة، أو لعملية ماتت (عامل أُعيد تشغيله)."""
+    global _slot
+    n = len(FIELDS)
+    with _shared.get_lock():
+        for i in range(STATS_SLOTS):
+            pid = _shared[i * n]
+            if pid == 0 or pid == os.getpid() or not _alive(pid):
+                _shared[i * n:(i + 1) * n] = [os.getpid()] + [0] * (n - 1)
+                _slot = i; return
+    _slot = None   # الخانات ممتلئة: هذه العملية لا تُحتسب
+
+def _bump(field, d=1):
+    if _slot is None: return
+    with _shared.get_lock():
+        _shared[_slot * len(FIELDS) + FIELDS.index(field)] += d
+
+def _count_request(request):
+    _bump("http_requests")
+
+def init():
+    """بناء الموارد لهذه العملية (يُستدعى عند الإقلاع، ويُعاد تلقائياً بعد fork)."""
+    global _pid, _pg, _pg_sem, _neo, _http
+    with _lock:
+        if _pid == os.getpid(): return
+        if _pid is not None: _inherited.append((_pg, _neo, _http))
+        _pg = ThreadedConnectionPool(PG_POOL_MIN, PG_POOL_MAX, DB_URL)
+        _pg_sem = threading.BoundedSemaphore(PG_POOL_MAX)
+        _neo = GraphDatabase.driver(NEO4J_URI, auth=_neo4j_auth(), max_connection_pool_size=NEO4J_POOL_SIZE)
+        _http = httpx.Client(limits=httpx.Limits(max_connections=HTTP_MAX_CONN,
+                                                 max_keepalive_connections=HTTP_KEEPALIVE),
+                             event_hooks={"request": [_count_request]})
+        _claim_slot()
+        _pid = os.getpid()
+
+def _ensure():
+    if _pid != os.getpid(): init()
+
+@contextlib.contextmanager
+def pg(autocommit: bool = True):
+    """اتصال من الـ pool؛ ينتظر بدل رمي PoolError عند امتلاء الـ pool."""
+    _ensure()
+    if not _pg_sem.acquire(blocking=False):
+        _bump("pg_waits")
+        _pg_sem.acquire()
+    conn = None
+    try:
+        conn = _pg.getconn()
+        if conn.closed:
+            _pg.putconn(conn, close=True); conn = _pg.getconn()
+        conn.autocommit = autocommit
+        _bump("pg_checkouts"); _bump("pg_in_use")
+        try:
+            yield conn
+            if not autocommit: conn.commit()
+        except Exception:
+            if not conn.closed and not autocommit: conn.rollback()
+            raise
+    finally:
+        if conn is not None:
+            _pg.putconn(conn, close=bool(conn.closed)); _bump("pg_in_use", -1)
+        _pg_sem.release()
+
+def neo4j():
+    _ensure(); return _neo
+
+def http():
+    _ensure(); return _http
+
+def close():
+    global _pid
+    with _lock:
+        if _pid != os.getpid(): return
+        _pg.closeall(); _neo.close(); _http.close()
+        if _slot is not None:
+            with _shared.get_lock(): _shared[_slot * len(FIELDS)] = 0
+        _pid = None
+
+def stats() -> dict:
+    """مجموع كل العمليات الحية (الـ API والعمال) مع تفصيل لكل pid."""
+    n = len(FIELDS)
+    with _shared.get_lock(): vals = _shared[:]
+    procs = [dict(zip(FIELDS, vals[i * n:(i + 1) * n])) for i in range(STATS_SLOTS)]
+    procs = [p for p in procs if p["pid"] and _alive(p["pid"])]
+    tot = lambda k: sum(p[k] for p in procs)
+    return {
+        "processes": len(procs),
+        "postgres": {"min": PG_POOL_MIN, "max_per_process": PG_POOL_MAX, "in_use": tot("pg_in_use"),
+                     "checkouts": tot("pg_checkouts"), "waits": tot("pg_waits")},
+        "neo4j": {"uri": NEO4J_URI, "max_pool_size": NEO4J_POOL_SIZE},
+        "http": {"max_connections": HTTP_MAX_CONN, "max_keepalive": HTTP_KEEPALIVE,
+                 "requests": tot("http_requests")},
+        "per_process": procs,
+    }
@@ -0,0 +1,66 @@
+"""عدد الرحلات إلى Postgres/Neo4j في كتابة الكيانات ثابت مهما كبر عددها."""
+import os, sys
+from collections import Counter
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import worker
+
+TYPES = ("PERSON", "LOC", "ORG")
+
+class StubConn:
+    encoding = "UTF8"
+
+class StubCursor:
+    """يكفي execute_values: mogrify/execute/fetchall، ويعدّ العبارات لكل جدول.
+    RETURNING يعود بترتيب معكوس (Postgres لا يضمن ترتيب VALUES)."""
+    connection = StubConn()
+    def __init__(self, reverse=True):
+        self.tables, self.reverse = Counter(), reverse
+        self._args, self._ret, self.mentions = [], [], []
+    def mogrify(self, template, args):
+        self._args.append(args)
+        return b"(" + b",".join(repr(a).encode() for a in args) + b")"
+    def execute(self, sql, args=None):
+        sql = sql.decode() if isinstance(sql, bytes) else sql
+        table = sql.split("INSERT INTO ", 1)[1].split("(", 1)[0]
+        self.tables[table] += 1
+        if table == "nlp_entities":
+            self._ret = [(f"id-{i}", et, val) for i, (_, et, val, _) in enumerate(self._args)]
+            if self.reverse: self._ret.reverse()
+        else:
+            self.mentions = list(self._args)
+        self._args = []
+    def fetchall(self):
+        return self._ret
+
+class StubSession:
+    def __init__(self): self.runs = []
+    def run(self, cypher, **params): self.runs.append(params)
+
+def entities(n):
+    return [{"text": f"v{i}", "type": TYPES[i % len(TYPES)].lower(), "start": i, "end": i + 2} for i in range(n)]
+
+@pytest.mark.parametrize("n", [10, 100, 1000])
+def test_pg_one_statement_per_table(n):
+    cur, rows = StubCursor(), worker.entity_rows(entities(n))
+    ids = worker.write_entities_pg(cur, "case-1", 42, rows)
+    assert len(ids) == n
+    assert cur.tables == {"nlp_entities": 1, "entity_mentions": 1}
+
+@pytest.mark.parametrize("n", [10, 100, 1000])
+def test_graph_one_call_per_entity_type(n):
+    s, rows = StubSession(), worker.entity_rows(entities(n))
+    assert worker.write_entities_graph(s, "case-1", rows) == len(TYPES)
+    assert len(s.runs) == len(TYPES)
+    assert sum(len(r["vals"]) for r in s.runs) == n
+
+def test_pg_ids_follow_keys_not_returning_order():
+    cur = StubCursor(reverse=True)
+    rows = worker.entity_rows(entities(7) + [{"text": "v0", "type": "person", "start": 50, "end": 52}])
+    ids = worker.write_entities_pg(cur, "case-1", 42, rows)
+    inserted = {f"id-{i}": (r[0], r[1]) for i, r in enumerate(rows)}
+    # كل id يشير إلى كيان بنفس (type, value) للصف المقابل، وكل id يُستخدم مرة واحدة
+    assert [inserted[i] for i in ids] == [(r[0], r[1]) for r in rows]
+    assert len(set(ids)) == len(rows)
+    assert [(m[1], m[2], m[3]) for m in cur.mentions] == [(i, r[2], r[3]) for i, r in zip(ids, rows)]
@@ -1,118 +1,257 @@
-import os, tempfile, subprocess, hashlib
+import os, re, tempfile, subprocess, hashlib
+from collections import defaultdict
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 from minio import Minio
-import httpx, psycopg2
-from neo4j import GraphDatabase
+from psycopg2.extras import execute_values
+import jobqueue, resources
 
 def env(k, d=None): return os.getenv(k, d)
 
-DB_URL           = env("DB_URL")
 MINIO_URL        = env("MINIO_URL","http://minio:9000")
 MINIO_ACCESS_KEY = env("MINIO_ACCESS_KEY")
 MINIO_SECRET_KEY = env("MINIO_SECRET_KEY")
 ASR_URL          = env("ASR_URL","http://asr-engine:8004")
+ASR_TIMEOUT      = float(env("ASR_TIMEOUT","600"))
 NEURAL_CORE_URL  = env("NEURAL_CORE_URL","http://neural-core:8000")
-NEO4J_URI        = env("NEO4J_URI","bolt://neo4j:7687")
-NEO4J_AUTH       = env("NEO4J_AUTH","none")
 
 client = Minio(MINIO_URL.replace("http://","").replace("https://",""),
                access_key=MINIO_ACCESS_KEY, secret_key=MINIO_SECRET_KEY, secure=MINIO_URL.startswith("https"))
 
+CHUNK            = int(env("INGEST_CHUNK_BYTES", str(1024*1024)))
+STREAM_INGEST    = env("STREAM_INGEST","1") == "1"
+DEDUP_ENABLED    = env("DEDUP_ENABLED","1") == "1"
+# تخطي التنزيل بالاعتماد على sha256 مُعلن غير مُتحقق منه (معطّل افتراضياً لسلامة الأدلة)
+DEDUP_TRUST_CLAIMED = env("DEDUP_TRUST_CLAIMED_HASH","0") == "1"
+# نسخة خط ASR+NER؛ تغييرها يبطل ذاكرة المحتوى
+MODEL_VERSION    = env("INGEST_MODEL_VERSION", f'{env("ASR_MODEL_VERSION","medium")}+{env("NER_MODEL_VERSION","neural-core")}')
+VIDEO_EXT        = (".mp4",".mkv",".avi",".mov",".webm")
+# حاويات قد تضع الفهرس (moov) في نهاية الملف، فيحتاج ffmpeg وصولاً عشوائياً إليها
+SEEK_EXT         = tuple(e.strip() for e in env("INGEST_SEEK_EXT",".mp4,.mov,.m4a,.3gp").split(",") if e.strip())
+
 def sha256_file(p):
     h=hashlib.sha256()
     with open(p,"rb") as f:
-        for b in iter(lambda:f.read(1024*1024), b""):
+        for b in iter(lambda:f.read(CHUNK), b""):
             h.update(b)
     return h.hexdigest()
 
+def to_wav_cmd(src, dst):
+    return ["ffmpeg","-y","-i",src,"-vn","-ac","1","-ar","16000",dst]
+
+def stream_object(bucket, key, td):
+    """قراءة الكائن من MinIO مرة واحدة: sha256 تدريجي وتمرير نفس البايتات
+    إلى stdin لـ ffmpeg لإنتاج wav أحادي 16kHz. النسخة المحلية تُحفظ فقط
+    للامتدادات التي تحتاج وصولاً عشوائياً (SEEK_EXT)."""
+    ext = os.path.splitext(key)[1].lower()
+    audio_path = os.path.join(td, "audio.16k.wav")
+    local = os.path.join(td, os.path.basename(key)) if ext in SEEK_EXT else None
+    h, size = hashlib.sha256(), 0
+    # الكائن أولاً: فشل get_object (NoSuchKey، صلاحيات) لا يترك ffmpeg يتيماً
+    resp = client.get_object(bucket, key)
+    ff = None
+    try:
+        if not local:
+            ff = subprocess.Popen(to_wav_cmd("pipe:0", audio_path), stdin=subprocess.PIPE,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with (open(local,"wb") if local else open(os.devnull,"wb")) as out:
+            for b in resp.stream(CHUNK):
+                h.update(b); size += len(b)
+                if local: out.write(b)
+                elif ff.stdin:
+                    try: ff.stdin.write(b)
+                    except BrokenPipeError:
+                        # ffmpeg أنهى مبكراً؛ نكمل القراءة لإتمام الـ hash
+                        ff.stdin.close(); ff.stdin=None
+    except BaseException:
+        # خطأ أثناء البث: لا نترك ffmpeg معلقاً على stdin أو zombie في عامل طويل العمر
+        if ff:
+            ff.kill(); ff.wait()
+        raise
+    finally:
+        resp.close(); resp.release_conn()
+        if ff and ff.stdin: ff.stdin.close()
+    if ff:
+        if ff.wait() != 0: raise RuntimeError(f"ffmpeg failed on {key} (rc={ff.returncode})")
+    else:
+        subprocess.run(to_wav_cmd(local, audio_path), check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return {"size": size, "sha256": h.hexdigest(), "audio_path": audio_path, "local": local,
+            "media_type": "video" if ext in VIDEO_EXT else "audio"}
+
+def fetch_object(bucket, key, td):
+    """المسار القديم: تنزيل كامل ثم hash ثم ffmpeg (STREAM_INGEST=0)."""
+    local = os.path.join(td, os.path.basename(key))
+    client.fget_object(bucket, key, local)
+    ext = os.path.splitext(local)[1].lower()
+    media_type, audio_path = "audio", local
+    if ext in VIDEO_EXT:
+        media_type = "video"
+        audio_path = os.path.join(td, "audio.16k.wav")
+        subprocess.run(to_wav_cmd(local, audio_path), check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return {"size": os.path.getsize(local), "sha256": sha256_file(local), "audio_path": audio_path,
+            "local": local, "media_type": media_type}
+
+LABEL_RX = re.compile(r"[^A-Za-z0-9_]")
+
+def entity_rows(entities):
+    """تطبيع مخرجات neural-core إلى (type, value, start, end) مع label آمن لـ Cypher."""
+    rows = []
+    for e in entities:
+        val = e.get("text") or e.get("value")
+        if not val: continue
+        et = LABEL_RX.sub("_", (e.get("type") or e.get("label") or "ENTITY").upper()) or "ENTITY"
+        if et[0].isdigit(): et = "E_" + et
+        start, end = e.get("start"), e.get("end")
+        rows.append((et, val, start if isinstance(start, int) else None, end if isinstance(end, int) else None))
+    return rows
+
+def write_entities_pg(cur, case_id, transcript_id, rows, source="neural-core"):
+    """إدراج كل الكيانات بعبارة واحدة (multi-row VALUES) + روابط entity_mentions.
+    ترتيب RETURNING غير مضمون، فالـ ids تُربط بالصفوف بالمفتاح (type, value)؛ الصفوف
+    المتكررة بنفس المفتاح متكافئة فأي id منها يصلح."""
+    if not rows: return []
+    by_key = defaultdict(list)
+    for eid, et, val in execute_values(cur,
+            "INSERT INTO nlp_entities(case_id,entity_type,value,source) VALUES %s RETURNING id, entity_type, value",
+            [(case_id, et, val, source) for et, val, _, _ in rows], page_size=len(rows), fetch=True):
+        by_key[et, val].append(eid)
+    ids = [by_key[et, val].pop() for et, val, _, _ in rows]
+    if transcript_id:
+        execute_values(cur,
+            "INSERT INTO entity_mentions(transcript_id,entity_id,start_char,end_char) VALUES %s",
+            [(transcript_id, eid, r[2], r[3]) for eid, r in zip(ids, rows)], page_size=len(rows))
+    return ids
+
+def link_case_entities(cur, case_id, rows, source="neural-core"):
+    """إصابة الذاكرة: كيانات القضية الجديدة فقط (بلا entity_mentions — مواضعها مسجلة مع الـ transcript
+    المخزن)، وما سُجّل للقضية من قبل لا يُكرر. عبارة واحدة."""
+    vals = sorted({(et, val) for et, val, _, _ in rows})
+    if not vals: return 0
+    execute_values(cur, """
+        INSERT INTO nlp_entities(case_id,entity_type,value,source)
+        SELECT v.case_id, v.entity_type, v.value, v.source FROM (VALUES %s) v(case_id,entity_type,value,source)
+        WHERE NOT EXISTS (SELECT 1 FROM nlp_entities e WHERE e.case_id IS NOT DISTINCT FROM v.case_id
+                          AND e.entity_type=v.entity_type AND e.value=v.value)""",
+        [(case_id, et, val, source) for et, val in vals], page_size=len(vals))
+    return cur.rowcount
+
+def write_entities_graph(s, case_id, rows):
+    """MERGE الكيانات بـ UNWIND: استعلام واحد لكل نوع كيان مهما كان عددها."""
+    by_type = defaultdict(set)
+    for et, val, _, _ in rows: by_type[et].add(val)
+    for et, vals in by_type.items():
+        s.run("""
+        MERGE (c:Case {case_id:$case_id})
+        WITH c UNWIND $vals AS val
+        MERGE (e:`%s` {value:val})
+        MERGE (c)-[:MENTIONS]->(e)
+        """ % et, case_id=case_id, vals=sorted(vals))
+    return len(by_type)
+
+def dedup_lookup(sha):
+    """ذاكرة معنونة بالمحتوى: (sha256, MODEL_VERSION) → transcript + كيانات موجودة مسبقاً."""
+    if not DEDUP_ENABLED or not sha: return None
+    with resources.pg() as conn, conn.cursor() as cur:
+        cur.execute("""SELECT t.id, t.lang, t.text FROM media_assets m JOIN transcripts t ON t.media_id=m.id
+                       WHERE m.sha256=%s AND t.model_version=%s ORDER BY t.created_at DESC LIMIT 1""",
+                    (sha, MODEL_VERSION))
+        hit = cur.fetchone()
+        if not hit: return None
+        cur.execute("""SELECT DISTINCT e.entity_type, e.value, em.start_char, em.end_char
+                       FROM entity_mentions em JOIN nlp_entities e ON e.id=em.entity_id
+                       WHERE em.transcript_id=%s""", (hit[0],))
+        return {"transcript_id": hit[0], "lang": hit[1], "text": hit[2], "rows": [tuple(r) for r in cur.fetchall()]}
+
+def claimed_sha256(req):
+    """hash مُعلن (من الطلب أو من metadata الكائن) يسمح بتخطي التنزيل كلياً عند الإصابة."""
+    if not DEDUP_TRUST_CLAIMED: return None, None
+    st = client.stat_object(req.bucket, req.key)
+    sha = req.sha256 or (st.metadata or {}).get("x-amz-meta-sha256")
+    return (sha.lower() if sha else None), st.size
+
 class IngestReq(BaseModel):
     bucket: str
     key: str
     case_id: str | None = None
+    sha256: str | None = None
 
-app = FastAPI(title="Ingest Worker", version="1.0")
+app = FastAPI(title="Ingest Worker", version="1.2")
 
-@app.get("/health")
-def health(): return {"status":"healthy","service":"ingest-worker"}
+def _noop(stage, progress): pass
 
-@app.post("/ingest/object")
-async def ingest_object(req: IngestReq):
-    # 1) تنزيل من MinIO
+def run_ingest(payload: dict, progress=_noop):
+    """خط المعالجة الكامل لكائن واحد (يعمل داخل عملية عامل، متزامن بالكامل)."""
+    req = IngestReq(**payload)
+    sha, size = claimed_sha256(req) if DEDUP_ENABLED else (None, None)
+    cached = dedup_lookup(sha)
+    media_type = "video" if os.path.splitext(req.key)[1].lower() in VIDEO_EXT else "audio"
     with tempfile.TemporaryDirectory() as td:
-        local = os.path.join(td, os.path.basename(req.key))
-        client.fget_object(req.bucket, req.key, local)
-        size = os.path.getsize(local)
-        sha = sha256_file(local)
-
-        # 2) تحديد النوع واستخراج الصوت لو فيديو
-        ext = os.path.splitext(local)[1].lower()
-        media_type = "audio"
-        audio_path = local
-        if ext in (".mp4",".mkv",".avi",".mov",".webm"):
-            media_type = "video"
-            audio_path = os.path.join(td, "audio.wav")
-            subprocess.run(["ffmpeg","-y","-i",local,"-vn","-ac","1","-ar","16000",audio_path],
-                           check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-        # 3) استدعاء ASR
-        text, lang = None, None
-        try:
-            async with httpx.AsyncClient(timeout=120) as cli:
-                with open(audio_path,"rb") as f:
-                    r = await cli.post(f"{ASR_URL}/transcribe", files={"file":("input.wav",f,"audio/wav")})
-                data = r.json()
-                text = data.get("text") or data.get("transcript")
-                lang = data.get("lang") or "ar"
-        except Exception:
-            text = None
+        # 1+2) قراءة من MinIO مع hash واستخراج صوت 16kHz في تمريرة واحدة
+        if cached is None:
+            progress("ffmpeg", 0.05)
+            with jobqueue.stage("ffmpeg"):
+                obj = stream_object(req.bucket, req.key, td) if STREAM_INGEST else fetch_object(req.bucket, req.key, td)
+            size, sha, media_type, audio_path = obj["size"], obj["sha256"], obj["media_type"], obj["audio_path"]
+            cached = dedup_lookup(sha)
+
+        # 3) استدعاء ASR (يُتخطى عند الإصابة في ذاكرة المحتوى)
+        text, lang, transcript_id = None, None, None
+        if cached:
+            text, lang, transcript_id = cached["text"], cached["lang"], cached["transcript_id"]
+        else:
+            progress("asr", 0.3)
+            try:
+                with jobqueue.stage("asr"):
+                    with open(audio_path,"rb") as f:
+                        r = resources.http().post(f"{ASR_URL}/transcribe/upload", files={"file":("input.wav",f,"audio/wav")},
+                                                  timeout=ASR_TIMEOUT)
+                    data = r.json()
+                    text = data.get("text") or data.get("transcript")
+                    lang = data.get("lang") or data.get("language") or "ar"
+            except Exception:
+                text = None
 
         # 4) تخزين media + transcript في Postgres
-        with psycopg2.connect(DB_URL) as conn:
-            conn.autocommit = True
+        progress("db", 0.6)
+        with resources.pg() as conn:
             with conn.cursor() as cur:
-                cur.execute("""INSERT INTO media_assets(case_id,bucket,object_key,media_type,size_bytes,sha256)
-                               VALUES (%s,%s,%s,%s,%s,%s) RETURNING id""",
-                            (req.case_id, req.bucket, req.key, media_type, size, sha))
+                # الإصابة تربط الـ media الجديد بالـ transcript المخزن صراحةً (case → media → transcript)
+                cur.execute("""INSERT INTO media_assets(case_id,bucket,object_key,media_type,size_bytes,sha256,transcript_id)
+                               VALUES (%s,%s,%s,%s,%s,%s,%s) RETURNING id""",
+                            (req.case_id, req.bucket, req.key, media_type, size, sha, transcript_id))
                 media_id = cur.fetchone()[0]
-                transcript_id = None
-                if text:
-                    cur.execute("""INSERT INTO transcripts(media_id,lang,text) VALUES (%s,%s,%s) RETURNING id""",
-                                (media_id, lang, text))
+                if text and not cached:
+                    cur.execute("""INSERT INTO transcripts(media_id,lang,text,model_version) VALUES (%s,%s,%s,%s)
+                                   RETURNING id""", (media_id, lang, text, MODEL_VERSION))
                     transcript_id = cur.fetchone()[0]
+                    cur.execute("UPDATE media_assets SET transcript_id=%s WHERE id=%s", (transcript_id, media_id))
 
-        # 5) استخراج كيانات عبر Neural-Core
-        entities = []
-        if text:
-            try:
-                async with httpx.AsyncClient(timeout=30) as cli:
-                    r = await cli.post(f"{NEURAL_CORE_URL}/analyze", json={"text": text, "language": lang})
+        # 5) استخراج كيانات عبر Neural-Core (أو إعادة استخدام كيانات الإصابة)
+        if cached:
+            rows = cached["rows"]
+        else:
+            progress("ner", 0.7)
+            entities = []
+            if text:
+                try:
+                    r = resources.http().post(f"{NEURAL_CORE_URL}/analyze", json={"text": text, "language": lang},
+                                              timeout=30)
                     entities = r.json().get("analysis",{}).get("entities",[])
-            except Exception:
-                entities = []
+                except Exception:
+                    entities = []
+            rows = entity_rows(entities)
 
         # 6) كتابة الكيانات وربطها
-        with psycopg2.connect(DB_URL) as conn:
-            conn.autocommit = True
-            new_ids=[]
+        with resources.pg(autocommit=False) as conn:
             with conn.cursor() as cur:
-                for e in entities:
-                    et = (e.get("type") or e.get("label") or "ENTITY").upper()
-                    val = e.get("text") or e.get("value")
-                    if not val: continue
-                    cur.execute("""INSERT INTO nlp_entities(case_id,entity_type,value,source)
-                                   VALUES (%s,%s,%s,%s) RETURNING id""",
-                                (req.case_id, et, val, "neural-core"))
-                    new_ids.append(cur.fetchone()[0])
+                if cached: link_case_entities(cur, req.case_id, rows)
+                else: write_entities_pg(cur, req.case_id, transcript_id, rows)
 
         # 7) دفع للـ Neo4j
-        auth=None
-        if NEO4J_AUTH and NEO4J_AUTH.lower()!="none":
-            user,pw = NEO4J_AUTH.split("/",1) if "/" in NEO4J_AUTH else NEO4J_AUTH.split("/",1)
-            from neo4j import basic_auth
-            auth = basic_auth(user,pw)
-        driver = GraphDatabase.driver(NEO4J_URI, auth=auth)
-        with driver.session() as s:
+        progress("graph", 0.85)
+        with jobqueue.stage("graph"), resources.neo4j().session() as s:
             s.run("""
             MERGE (c:Case {case_id:$case_id})
             MERGE (m:Media {sha256:$sha})
@@ -126,15 +265,7 @@ async def ingest_object(req: IngestReq):
                   SET t.lang=$lang, t.text=$text
                 MERGE (m)-[:HAS_TRANSCRIPT]->(t)
                 """, sha=sha, tid=str(transcript_id), lang=lang, text=text)
-            for e in entities:
-                et = (e.get("type") or e.get("label") or "ENTITY").upper()
-                val = e.get("text") or e.get("value")
-                if not val: continue
-                s.run("""
-                MERGE (c:Case {case_id:$case_id})
-                MERGE (e:%s {value:$val})
-                MERGE (c)-[:MENTIONS]->(e)
-                """ % et, case_id=req.case_id, val=val)
+            write_entities_graph(s, req.case_id, rows)
 
         return {
             "status":"ok",
@@ -143,5 +274,54 @@ async def ingest_object(req: IngestReq):
             "size_bytes": size,
             "sha256": sha,
             "transcribed": bool(text),
-            "entities_count": len(entities)
+            "entities_count": len(rows),
+            "dedup": ("hit" if cached else "miss") if DEDUP_ENABLED else "off",
+            "model_version": MODEL_VERSION
         }
+
+DEDUP_SCHEMA = """
+ALTER TABLE transcripts ADD COLUMN IF NOT EXISTS model_version TEXT;
+ALTER TABLE media_assets ADD COLUMN IF NOT EXISTS transcript_id UUID REFERENCES transcripts(id) ON DELETE SET NULL;
+CREATE INDEX IF NOT EXISTS media_assets_sha256_idx ON media_assets(sha256);
+CREATE INDEX IF NOT EXISTS transcripts_media_model_idx ON transcripts(media_id, model_version);
+CREATE INDEX IF NOT EXISTS entity_mentions_transcript_idx ON entity_mentions(transcript_id);
+"""
+
+@app.on_event("startup")
+def startup():
+    resources.init()
+    jobqueue.ensure_schema()
+    with resources.pg() as conn, conn.cursor() as cur:
+        cur.execute(DEDUP_SCHEMA)
+    jobqueue.start(run_ingest)
+
+@app.on_event("shutdown")
+def shutdown():
+    jobqueue.stop()
+    resources.close()
+
+@app.get("/health")
+def health():
+    try:
+        return {"status":"healthy","service":"ingest-worker","queue":jobqueue.stats(),
+                "pools":resources.stats(),"dedup":jobqueue.dedup_stats()}
+    except Exception as e:
+        return {"status":"degraded","service":"ingest-worker","error":str(e)}
+
+@app.post("/ingest/object")
+def ingest_object(req: IngestReq):
+    return {"status":"queued","job_id":jobqueue.enqueue(req.dict())}
+
+@app.get("/dedup/stats")
+def dedup_stats():
+    return {"enabled":DEDUP_ENABLED,"model_version":MODEL_VERSION,**jobqueue.dedup_stats()}
+
+@app.get("/jobs")
+def jobs(status: str | None = None, limit: int = 50):
+    return jobqueue.list_jobs(status, min(limit, 500))
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    job = jobqueue.get_job(job_id)
+    if not job: raise HTTPException(404, "job not found")
+    return job
@@ -1,38 +1,95 @@
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
-import io, base64, requests, numpy as np, cv2
-from PIL import Image, ImageChops
-import imagehash, exifread
+import os, time, multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import pipeline, phashdb
 api=FastAPI()
-class Inp(BaseModel): image_url:str; ela_quality:int|None=90; heatmap:bool|None=False
-@api.get("/health") 
-def health(): return {"status":"ok"}
-def ela(img,q=90):
-    buf=io.BytesIO(); img.save(buf,'JPEG',quality=q)
-    comp=Image.open(io.BytesIO(buf.getvalue()))
-    diff=ImageChops.difference(img.convert('RGB'), comp.convert('RGB'))
-    arr=np.asarray(diff, dtype=np.int16)
-    return diff, float(np.abs(arr).mean()), float(np.percentile(np.abs(arr),95))
-def noise_energy(img):
-    g=np.array(img.convert('L'), dtype=np.float32)/255.0
-    resid=g-cv2.GaussianBlur(g,(0,0),1.0); return float(np.mean(resid**2))
-def exif_map(raw):
-    try:
-        tags=exifread.process_file(io.BytesIO(raw), details=False)
-        keep=("EXIF DateTimeOriginal","EXIF LensModel","Image Make","Image Model","GPS GPSLatitude","GPS GPSLongitude")
-        return {k:str(v) for k,v in tags.items() if k in keep}
-    except: return {}
+# العمل على البلاطات محصور بالـ CPU، فالدفعات تُوزع على عمليات (spawn: cv2 لا يحتمل fork بعد الخيوط)
+WORKERS=int(os.getenv("FORENSICS_WORKERS", str(max(1,(os.cpu_count() or 2)//2))))
+BATCH_MAX=int(os.getenv("FORENSICS_BATCH_MAX","500"))
+META_BATCH_MAX=int(os.getenv("FORENSICS_META_BATCH_MAX","20000"))
+PHASH_DB=os.getenv("PHASH_DB_PATH","/data/forensics/phash.sqlite")
+os.makedirs(os.path.dirname(PHASH_DB), exist_ok=True)
+hashes=phashdb.PHashDB(PHASH_DB)
+class ImageRef(BaseModel): image_url:str|None=None; bucket:str|None=None; key:str|None=None; case_id:str|None=None
+class Inp(ImageRef): ela_quality:int|None=90; heatmap:bool|None=False; index:bool=True
+class BatchInp(BaseModel): items:list[ImageRef]; ela_quality:int|None=90; heatmap:bool|None=False; index:bool=True
+class MetaInp(ImageRef): tags:bool=True
+class MetaBatchInp(BaseModel): items:list[ImageRef]; tags:bool=True
+def ref_of(it)->str|None:
+    return it.get("image_url") or (f"s3://{it['bucket']}/{it['key']}" if it.get("bucket") and it.get("key") else None)
+def index_results(results)->int|str:
+    """يضيف ahash/phash للنتائج الناجحة إلى مخزن التشابه (عبر كل القضايا).
+    فشل الفهرسة لا يُفشل التحليل: يعود نص الخطأ بدل العدد."""
+    rows=[{**r,"ref":ref_of(r)} for r in results if "error" not in r]
+    try: return hashes.add_many(rows) if rows else 0
+    except Exception as e: return f"index failed: {e}"
+_pool=None
+def get_pool():
+    global _pool
+    if _pool is None: _pool=ProcessPoolExecutor(WORKERS, mp_context=mp.get_context("spawn"))
+    return _pool
+@api.on_event("shutdown")
+def shutdown():
+    if _pool is not None: _pool.shutdown(cancel_futures=True)
+@api.get("/health")
+def health(): return {"status":"ok","workers":WORKERS,"tile_px":pipeline.TILE,"preview_px":pipeline.PREVIEW_MAX,
+                       "exif_header_bytes":pipeline.HEADER_BYTES,
+                       "indexed_images":hashes.count()}
 @api.post("/analyze")
 def analyze(inp:Inp):
     try:
-        r=requests.get(inp.image_url, timeout=30); r.raise_for_status()
-        img=Image.open(io.BytesIO(r.content)).convert('RGB'); w,h=img.size
-        diff, m, p95 = ela(img, inp.ela_quality or 90)
-        nrg=noise_energy(img); ah=str(imagehash.average_hash(img)); ph=str(imagehash.phash(img))
-        exif=exif_map(r.content)
-        out={"width":w,"height":h,"ela_mean":m,"ela_p95":p95,"noise_energy":nrg,"ahash":ah,"phash":ph,"exif":exif}
-        if inp.heatmap:
-            b=io.BytesIO(); diff.save(b, format='PNG'); out["ela_heatmap_png_b64"]=base64.b64encode(b.getvalue()).decode()
+        t0=time.perf_counter()
+        raw=pipeline.fetch(inp.image_url, inp.bucket, inp.key)
+        t={"fetch":round((time.perf_counter()-t0)*1000,1)}
+        out=pipeline.analyze_bytes(raw, inp.ela_quality or 90, bool(inp.heatmap), t)
+        if inp.index:
+            n=index_results([{**inp.model_dump(include={"image_url","bucket","key","case_id"}),**out}])
+            if isinstance(n,str): out["indexed"]=False; out["index_error"]=n
+            else: out["indexed"]=bool(n)
         return out
+    except ValueError as e:
+        raise HTTPException(422, str(e))
     except Exception as e:
         raise HTTPException(500, str(e))
+@api.post("/analyze/batch")
+def analyze_batch(inp:BatchInp):
+    """صور كثيرة (URLs أو مفاتيح MinIO) على pool العمليات؛ النتائج بنفس ترتيب items،
+    والعنصر الفاشل يحمل error بدل إسقاط الدفعة."""
+    if len(inp.items)>BATCH_MAX: raise HTTPException(413, f"at most {BATCH_MAX} items per batch")
+    t0=time.time()
+    futs=[get_pool().submit(pipeline.analyze_item, it.model_dump(), inp.ela_quality or 90, bool(inp.heatmap))
+          for it in inp.items]
+    results=[f.result() for f in futs]
+    dt=time.time()-t0
+    indexed=index_results(results) if inp.index else 0
+    index_error=None
+    if isinstance(indexed,str): index_error, indexed=indexed, 0
+    return {"results":results,"count":len(results),"errors":sum(1 for r in results if "error" in r),
+            "indexed":indexed,"index_error":index_error,"elapsed_sec":round(dt,3),"images_per_sec":round(len(results)/dt,2) if dt else None}
+@api.get("/similar")
+def similar(hash:str, max_distance:int=8, kind:str="phash", case_id:str|None=None,
+            exclude_case:str|None=None, limit:int=100):
+    """صور مخزنة (من كل القضايا) على مسافة Hamming <= max_distance من hash (hex 64 بت)."""
+    try: out=hashes.similar(hash, max_distance, kind, case_id, exclude_case, max(1,limit))
+    except ValueError as e: raise HTTPException(422, str(e))
+    return {"indexed":hashes.count(),**out}
+@api.post("/metadata")
+def metadata(inp:MetaInp):
+    """EXIF فقط: قراءة محدودة للرأس (EXIF_HEADER_BYTES) بلا فك بكسلات."""
+    if not ref_of(inp.model_dump()): raise HTTPException(422, "one of image_url or bucket+key is required")
+    out=pipeline.metadata_item(inp.model_dump(exclude={"tags"}), inp.tags)
+    if "error" in out: raise HTTPException(502, out["error"])
+    return out
+@api.post("/metadata/batch")
+def metadata_batch(inp:MetaBatchInp):
+    """مسح بيانات وصفية لآلاف الصور (طوابع زمنية و GPS) على pool العمليات، بنفس ترتيب items."""
+    if len(inp.items)>META_BATCH_MAX: raise HTTPException(413, f"at most {META_BATCH_MAX} items per batch")
+    t0=time.time()
+    results=list(get_pool().map(partial(pipeline.metadata_item, tags=inp.tags),
+                                [it.model_dump() for it in inp.items], chunksize=16))
+    dt=time.time()-t0
+    return {"results":results,"count":len(results),"errors":sum(1 for r in results if "error" in r),
+            "with_gps":sum(1 for r in results if r.get("gps")),
+            "elapsed_sec":round(dt,3),"images_per_sec":round(len(results)/dt,1) if dt else None}
@@ -0,0 +1,124 @@
+"""مخزن ahash/phash مع فهرسة متعددة (multi-index hashing) لاستعلامات مسافة Hamming.
+
+الـ hash (64 بت) يُقسم إلى 3 أجزاء (21/21/22 بت ≈ log2 لملايين الصور، فكل قيمة
+جزء تقابل عدداً قليلاً من الصور)، ولكل جزء فهرس. بمبدأ برج الحمام: أي hash على
+مسافة ≤ r يطابق جزءاً واحداً على الأقل ضمن مسافة ≤ r//3، فنستعلم قيم كل جزء ضمن
+هذا النصف قطر ثم نتحقق بـ popcount على الـ hash الكامل المخزّن مع الجزء.
+"""
+import sqlite3, threading, time
+from itertools import combinations
+
+WIDTHS = (21, 21, 22)
+MAX_DISTANCE = 14
+KINDS = ("phash", "ahash")
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS images(id INTEGER PRIMARY KEY, case_id TEXT, ref TEXT NOT NULL,
+       sha256 TEXT, phash INTEGER NOT NULL, ahash INTEGER NOT NULL, width INTEGER, height INTEGER,
+       added_at REAL, UNIQUE(case_id, ref))""",
+    """CREATE TABLE IF NOT EXISTS hash_part(kind TEXT NOT NULL, part INTEGER NOT NULL, val INTEGER NOT NULL,
+       id INTEGER NOT NULL, full INTEGER NOT NULL, PRIMARY KEY(kind, part, val, id)) WITHOUT ROWID""",
+)
+
+def to_int(hexhash: str) -> int:
+    v = int(hexhash, 16)
+    if v >> 64: raise ValueError("hash must be 64 bits")
+    return v
+
+def _signed(v: int) -> int:   # SQLite INTEGER = int64
+    return v - (1 << 64) if v >> 63 else v
+
+def _parts(v: int):
+    out, shift = [], 0
+    for w in WIDTHS:
+        out.append((v >> shift) & ((1 << w) - 1)); shift += w
+    return out
+
+_flips = {}
+def _neighbours(val: int, bits: int, r: int):
+    if (bits, r) not in _flips:
+        _flips[bits, r] = [sum(1 << b for b in c) for k in range(r + 1) for c in combinations(range(bits), k)]
+    return [val ^ f for f in _flips[bits, r]]
+
+class PHashDB:
+    def __init__(self, path: str):
+        self.path = path
+        self._wlock = threading.Lock()
+        con = self._connect()
+        con.execute("PRAGMA journal_mode=WAL")
+        for q in SCHEMA: con.execute(q)
+        con.commit(); con.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def add_many(self, items) -> int:
+        """items: dicts بنتيجة analyze (ahash, phash, ref, case_id, sha256, width, height).
+        نفس (case_id, ref) يُستبدل. BEGIN IMMEDIATE يأخذ قفل الكتابة قبل SELECT، فعمليتا
+        uvicorn لا تفوّتان الصف القديم معاً (UNIQUE أو تكرار مع case_id NULL)."""
+        n = 0
+        with self._wlock:
+            con = self._connect()
+            con.isolation_level = None
+            try:
+                con.execute("BEGIN IMMEDIATE")
+                for it in items:
+                    if not it.get("phash") or not it.get("ahash") or not it.get("ref"): continue
+                    hs = {k: to_int(it[k]) for k in KINDS}
+                    old = con.execute("SELECT id FROM images WHERE case_id IS ? AND ref=?", (it.get("case_id"), it["ref"])).fetchone()
+                    if old:
+                        con.execute("DELETE FROM hash_part WHERE id=?", old)
+                        con.execute("DELETE FROM images WHERE id=?", old)
+                    fid = con.execute("""INSERT INTO images(case_id,ref,sha256,phash,ahash,width,height,added_at)
+                                         VALUES(?,?,?,?,?,?,?,?)""",
+                                      (it.get("case_id"), it["ref"], it.get("sha256"), _signed(hs["phash"]),
+                                       _signed(hs["ahash"]), it.get("width"), it.get("height"), time.time())).lastrowid
+                    con.executemany("INSERT INTO hash_part(kind,part,val,id,full) VALUES(?,?,?,?,?)",
+                                    [(k, i, p, fid, _signed(hs[k])) for k in KINDS for i, p in enumerate(_parts(hs[k]))])
+                    n += 1
+                con.execute("COMMIT")
+            except BaseException:
+                if con.in_transaction: con.execute("ROLLBACK")
+                raise
+            finally: con.close()
+        return n
+
+    def similar(self, hexhash: str, max_distance: int = 8, kind: str = "phash", case_id=None,
+                exclude_case=None, limit: int = 100) -> dict:
+        t0 = time.perf_counter()
+        if kind not in KINDS: raise ValueError(f"kind must be one of {KINDS}")
+        q = to_int(hexhash)
+        r = max(0, min(max_distance, MAX_DISTANCE))
+        con = self._connect()
+        try:
+            cand, near = set(), {}
+            for i, p in enumerate(_parts(q)):
+                vals = _neighbours(p, WIDTHS[i], r // len(WIDTHS))
+                for j in range(0, len(vals), 900):
+                    part = vals[j:j + 900]
+                    for fid, full in con.execute(
+                            f"SELECT id, full FROM hash_part WHERE kind=? AND part=? AND val IN ({','.join('?' * len(part))})",
+                            [kind, i, *part]):
+                        cand.add(fid)
+                        d = ((full & ((1 << 64) - 1)) ^ q).bit_count()
+                        if d <= r: near[fid] = d
+            hits = []
+            ids = list(near)
+            for j in range(0, len(ids), 900):
+                part = ids[j:j + 900]
+                for fid, cid, ref, sha, w, ht in con.execute(
+                        f"SELECT id,case_id,ref,sha256,width,height FROM images WHERE id IN ({','.join('?' * len(part))})",
+                        part):
+                    if case_id is not None and cid != case_id: continue
+                    if exclude_case is not None and cid == exclude_case: continue
+                    hits.append({"id": fid, "case_id": cid, "ref": ref, "sha256": sha, "distance": near[fid],
+                                 "width": w, "height": ht})
+        finally: con.close()
+        hits.sort(key=lambda x: (x["distance"], x["id"]))
+        return {"hits": hits[:limit], "candidates": len(cand), "max_distance": r, "kind": kind,
+                "latency_ms": round((time.perf_counter() - t0) * 1000, 2)}
+
+    def count(self) -> int:
+        con = self._connect()
+        try: return con.execute("SELECT count(*) FROM images").fetchone()[0]
+        finally: con.close()
@@ -0,0 +1,202 @@
+"""تحليل صورة واحدة على بلاطات (tiles) بذاكرة محدودة؛ يُستدعى من /analyze مباشرة
+ومن /analyze/batch على ProcessPoolExecutor (دوال على مستوى الوحدة → قابلة للـ pickle).
+
+- ELA: كل بلاطة (مضاعف 16 بكسل → نفس شبكة كتل JPEG للصورة الكاملة) تُضغط JPEG
+  وتُطرح؛ |diff| يتراكم في histogram من 256 خانة بدل مصفوفة int16 كاملة،
+  فالمتوسط و p95 يُقرآن من الـ histogram دون فرز.
+- noise: GaussianBlur على كل بلاطة مع هامش HALO لتفادي أثر الحواف.
+- ahash/phash: من معاينة مصغّرة (PREVIEW_MAX) — كلاهما يصغّر إلى 8×8/32×32 أصلاً.
+- metadata: قراءة محدودة لرأس الملف فقط (EXIF_HEADER_BYTES عبر Range/offset) دون
+  فك البكسلات؛ exifread يعمل على هذه البايتات فقط.
+"""
+import io, os, time, base64, hashlib
+from fractions import Fraction
+import numpy as np, cv2, requests, imagehash, exifread
+from PIL import Image
+
+TILE = int(os.getenv("FORENSICS_TILE_PX", "1024")) // 16 * 16 or 16
+HALO = 4   # ≥ 3σ لـ GaussianBlur(σ=1)
+PREVIEW_MAX = int(os.getenv("FORENSICS_PREVIEW_PX", "1024"))
+MINIO_URL = os.getenv("MINIO_URL", "http://minio:9000")
+# APP1 (EXIF) في JPEG محدود بـ 64KB ويأتي قبل بيانات الصورة؛ الهامش للـ APP الأخرى و SOF
+HEADER_BYTES = int(os.getenv("EXIF_HEADER_BYTES", str(256 * 1024)))
+
+_minio = None
+def get_minio():
+    global _minio
+    if _minio is None:
+        from minio import Minio
+        _minio = Minio(MINIO_URL.replace("http://", "").replace("https://", ""),
+                       access_key=os.getenv("MINIO_ACCESS_KEY"), secret_key=os.getenv("MINIO_SECRET_KEY"),
+                       secure=MINIO_URL.startswith("https"))
+    return _minio
+
+def fetch(image_url=None, bucket=None, key=None) -> bytes:
+    if bucket and key:
+        resp = get_minio().get_object(bucket, key)
+        try: return resp.read()
+        finally: resp.close(); resp.release_conn()
+    if not image_url: raise ValueError("one of image_url or bucket+key is required")
+    r = requests.get(image_url, timeout=30); r.raise_for_status()
+    return r.content
+
+def fetch_head(image_url=None, bucket=None, key=None, n=HEADER_BYTES) -> bytes:
+    """أول n بايت فقط (Range/offset)؛ إن تجاهل الخادم Range نتوقف عند n."""
+    if bucket and key:
+        resp = get_minio().get_object(bucket, key, offset=0, length=n)
+        try: return resp.read()
+        finally: resp.close(); resp.release_conn()
+    if not image_url: raise ValueError("one of image_url or bucket+key is required")
+    buf = bytearray()
+    with requests.get(image_url, headers={"Range": f"bytes=0-{n - 1}"}, timeout=30, stream=True) as r:
+        r.raise_for_status()
+        for b in r.iter_content(64 * 1024):
+            buf += b
+            if len(buf) >= n: break
+    return bytes(buf[:n])
+
+def _tiles(h, w):
+    for y in range(0, h, TILE):
+        for x in range(0, w, TILE):
+            yield y, x, min(y + TILE, h), min(x + TILE, w)
+
+def _hist_stats(hist, p=0.95):
+    n = int(hist.sum())
+    if not n: return 0.0, 0.0
+    mean = float((hist * np.arange(hist.size)).sum() / n)
+    return mean, float(np.searchsorted(np.cumsum(hist), p * n))
+
+def ela(rgb, q=90, heatmap=False):
+    """(mean, p95, heatmap_png|None) لـ |rgb - jpeg(rgb, q)| على كل القنوات."""
+    h, w = rgb.shape[:2]
+    hist = np.zeros(256, dtype=np.int64)
+    scale = min(1.0, PREVIEW_MAX / max(h, w))
+    heat = np.zeros((max(1, round(h * scale)), max(1, round(w * scale)), 3), np.uint8) if heatmap else None
+    for y0, x0, y1, x1 in _tiles(h, w):
+        bgr = np.ascontiguousarray(rgb[y0:y1, x0:x1, ::-1])
+        ok, enc = cv2.imencode(".jpg", bgr, [cv2.IMWRITE_JPEG_QUALITY, q])
+        diff = cv2.absdiff(bgr, cv2.imdecode(enc, cv2.IMREAD_COLOR))
+        hist += np.bincount(diff.ravel(), minlength=256)
+        if heat is not None:
+            ty0, tx0, ty1, tx1 = (round(v * scale) for v in (y0, x0, y1, x1))
+            if ty1 > ty0 and tx1 > tx0:
+                heat[ty0:ty1, tx0:tx1] = cv2.resize(diff, (tx1 - tx0, ty1 - ty0), interpolation=cv2.INTER_AREA)[..., ::-1]
+    mean, p95 = _hist_stats(hist)
+    png = None
+    if heat is not None:
+        b = io.BytesIO(); Image.fromarray(heat).save(b, format="PNG"); png = b.getvalue()
+    return mean, p95, png
+
+def noise_energy(rgb):
+    gray = cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY)
+    h, w = gray.shape
+    total = 0.0
+    for y0, x0, y1, x1 in _tiles(h, w):
+        ya, xa = max(0, y0 - HALO), max(0, x0 - HALO)
+        g = gray[ya:min(h, y1 + HALO), xa:min(w, x1 + HALO)].astype(np.float32) / 255.0
+        resid = (g - cv2.GaussianBlur(g, (0, 0), 1.0))[y0 - ya:y1 - ya, x0 - xa:x1 - xa]
+        total += float(np.square(resid, dtype=np.float64).sum())
+    return total / (h * w)
+
+def preview(img):
+    prev = img.copy(); prev.thumbnail((PREVIEW_MAX, PREVIEW_MAX), Image.BILINEAR)
+    return prev
+
+def perceptual_hashes(prev):
+    return str(imagehash.average_hash(prev)), str(imagehash.phash(prev))
+
+def _tag_value(tag):
+    v = tag.values
+    if isinstance(v, (str, bytes)):
+        return (v.decode(errors="replace") if isinstance(v, bytes) else v).strip("\x00 ")
+    if tag.field_type == 7: return tag.printable   # UNDEFINED: exifread يفك الأنواع المعروفة
+    v = [float(x) if isinstance(x, Fraction) else x for x in v]
+    return v[0] if len(v) == 1 else v
+
+def _dms(vals, ref):
+    if not isinstance(vals, list) or len(vals) != 3: return None
+    d = vals[0] + vals[1] / 60 + vals[2] / 3600
+    return round(-d if ref in ("S", "W") else d, 7)
+
+def _iso(dt, offset=None):
+    if not isinstance(dt, str) or len(dt) < 19 or dt.startswith("0000"): return None
+    return dt[:10].replace(":", "-") + "T" + dt[11:19] + (offset if isinstance(offset, str) else "")
+
+def exif_fields(head: bytes) -> dict:
+    """كل الوسوم (دون MakerNote/thumbnail) مجمّعة حسب IFD بقيم مهيكلة (أعداد، نسب → float)،
+    مع حقول مشتقة: datetime_original بصيغة ISO و gps بالدرجات العشرية."""
+    try: tags = exifread.process_file(io.BytesIO(head), details=False)
+    except Exception: tags = {}
+    groups = {}
+    for k, t in tags.items():
+        if " " not in k or k.startswith("JPEGThumbnail"): continue
+        g, name = k.split(" ", 1)
+        try: groups.setdefault(g, {})[name] = _tag_value(t)
+        except Exception: groups.setdefault(g, {})[name] = str(t)
+    ex, gps, img = groups.get("EXIF", {}), groups.get("GPS", {}), groups.get("Image", {})
+    lat, lon = _dms(gps.get("GPSLatitude"), gps.get("GPSLatitudeRef")), _dms(gps.get("GPSLongitude"), gps.get("GPSLongitudeRef"))
+    alt = gps.get("GPSAltitude")
+    return {"datetime_original": _iso(ex.get("DateTimeOriginal"), ex.get("OffsetTimeOriginal")),
+            "datetime": _iso(img.get("DateTime"), ex.get("OffsetTime")),
+            "make": img.get("Make"), "model": img.get("Model"), "lens": ex.get("LensModel"),
+            "gps": {"lat": lat, "lon": lon,
+                    "alt": (-alt if gps.get("GPSAltitudeRef") == 1 else alt) if isinstance(alt, float) else None}
+                   if lat is not None and lon is not None else None,
+            "tags": groups}
+
+def exif_map(raw):
+    """الملخص القديم (ستة وسوم كنص). /analyze يملك الملف كاملاً فنحلله كله: TIFF/DNG
+    تضع IFDs غالباً بعد بيانات الصورة؛ القراءة المحدودة للرأس خاصة بـ /metadata."""
+    try:
+        tags = exifread.process_file(io.BytesIO(raw), details=False)
+        keep = ("EXIF DateTimeOriginal", "EXIF LensModel", "Image Make", "Image Model", "GPS GPSLatitude", "GPS GPSLongitude")
+        return {k: str(v) for k, v in tags.items() if k in keep}
+    except Exception: return {}
+
+def metadata_item(item: dict, tags: bool = True) -> dict:
+    """وضع البيانات الوصفية: رأس محدود، بلا فك بكسلات؛ الأبعاد من ترويسة PIL الكسولة."""
+    t0 = time.perf_counter()
+    try:
+        head = fetch_head(item.get("image_url"), item.get("bucket"), item.get("key"))
+        out = {"header_bytes": len(head), **exif_fields(head)}
+        if not tags: out.pop("tags")
+        try:
+            with Image.open(io.BytesIO(head)) as im: out["format"], (out["width"], out["height"]) = im.format, im.size
+        except Exception: pass
+    except Exception as e:
+        out = {"error": str(e)}
+    out["elapsed_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+    return {**{k: v for k, v in item.items() if v is not None}, **out}
+
+def analyze_bytes(raw: bytes, ela_quality=90, heatmap=False, timings=None) -> dict:
+    t = timings if timings is not None else {}
+    def lap(name, t0): t[name] = round((time.perf_counter() - t0) * 1000, 1); return time.perf_counter()
+    t0 = time.perf_counter()
+    img = Image.open(io.BytesIO(raw)).convert("RGB"); w, h = img.size
+    prev, rgb = preview(img), np.asarray(img)
+    del img   # نسخة numpy تكفي للبلاطات؛ لا نبقي نسختين كاملتين
+    t0 = lap("decode", t0)
+    m, p95, png = ela(rgb, ela_quality or 90, heatmap)
+    t0 = lap("ela", t0)
+    nrg = noise_energy(rgb)
+    t0 = lap("noise", t0)
+    ah, ph = perceptual_hashes(prev)
+    t0 = lap("hashes", t0)
+    exif = exif_map(raw)
+    lap("exif", t0)
+    out = {"sha256": hashlib.sha256(raw).hexdigest(), "width": w, "height": h, "ela_mean": m, "ela_p95": p95, "noise_energy": nrg,
+           "ahash": ah, "phash": ph, "exif": exif, "timings_ms": t}
+    if png is not None: out["ela_heatmap_png_b64"] = base64.b64encode(png).decode()
+    return out
+
+def analyze_item(item: dict, ela_quality=90, heatmap=False) -> dict:
+    """مهمة الـ pool: الجلب داخل العامل (لا تُنقل البايتات بين العمليات)."""
+    t = {}
+    try:
+        t0 = time.perf_counter()
+        raw = fetch(item.get("image_url"), item.get("bucket"), item.get("key"))
+        t["fetch"] = round((time.perf_counter() - t0) * 1000, 1)
+        out = analyze_bytes(raw, ela_quality, heatmap, t)
+    except Exception as e:
+        out = {"error": str(e), "timings_ms": t}
+    return {**{k: v for k, v in item.items() if v is not None}, **out}
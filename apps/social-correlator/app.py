@@ -1,10 +1,15 @@
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
-import os, re, psycopg
+import os, json, time, psycopg, multiprocessing as mp
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from dateutil import parser as dtp
 from rapidfuzz import fuzz
-import phonenumbers
+from rapidfuzz.process import cdist
+import numpy as np
 from neo4j import GraphDatabase
+import normalize
+from normalize import norm_handles, accounts_chunk, graph_key, graph_key_name
 
 api=FastAPI(title="social-correlator")
 
@@ -17,72 +22,117 @@ def db(): return psycopg.connect(host=DBH, port=DBPORT, dbname=DBN, user=DBU, pa
 NEO_URI=os.getenv("NEO4J_URI","bolt://neo4j:7687"); NEO_USER=os.getenv("NEO4J_USER","neo4j"); NEO_PASS=os.getenv("NEO4J_PASSWORD")
 def bolt(): return GraphDatabase.driver(NEO_URI, auth=(NEO_USER, NEO_PASS))
 
-HANDLE_RX=re.compile(r"^@?([A-Za-z0-9._-]{3,})$")
-EMAIL_RX=re.compile(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}")
-PHONE_RX=re.compile(r"\+?\d[\d\s().-]{6,}")
+# استخراج الحسابات: cursor على الخادم بدفعات ITERSIZE، والتطبيع على عمليات NORM_WORKERS
+# (PHONE_DEFAULT_REGION و NORM_CACHE_SIZE تقرأهما normalize.py في كل عامل)
+ITERSIZE=int(os.getenv("ACCOUNTS_ITERSIZE","20000"))
+NORM_WORKERS=int(os.getenv("NORM_WORKERS", str(max(1,(os.cpu_count() or 2)-1))))
+_pool=None
+def norm_pool():
+    global _pool
+    if _pool is None: _pool=ProcessPoolExecutor(NORM_WORKERS, mp_context=mp.get_context("spawn"))
+    return _pool
 
-def norm_handle(s:str|None):
-    if not s: return None
-    m=HANDLE_RX.match(s.strip()); 
-    return m.group(1).lower() if m else None
-
-def norm_email(s:str): return s.strip().lower()
-
-def norm_phone(s:str):
-    s=s.strip()
-    try:
-        p=phonenumbers.parse(s, None)
-        if phonenumbers.is_possible_number(p) and phonenumbers.is_valid_number(p):
-            return phonenumbers.format_number(p, phonenumbers.PhoneNumberFormat.E164)
-    except: pass
-    return None
+ACCOUNT_KEY="platform, COALESCE(handle, 'name:'||name, ''), COALESCE(external_id,'')"
 
 def ensure_schema():
     with db() as c, c.cursor() as cur:
+        # المفتاح بتعابير COALESCE لا يصلح قيداً داخل الجدول؛ فهرس فريد بتعابير هو هدف ON CONFLICT
         cur.execute("""
         CREATE TABLE IF NOT EXISTS sm_accounts(
           id BIGSERIAL PRIMARY KEY,
           platform TEXT, handle TEXT, name TEXT, external_id TEXT,
           email TEXT, phone TEXT,
-          extra JSONB,
-          UNIQUE(platform, COALESCE(handle,''), COALESCE(external_id,''))
+          extra JSONB
         );
         """)
+        # حساب بلا handle مفتاحه اسمه (كما graph_key)، لا صف واحد لكل منصة
+        cur.execute("DROP INDEX IF EXISTS sm_accounts_key")
+        cur.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS sm_accounts_ukey ON sm_accounts({ACCOUNT_KEY})")
+        cur.execute(CONTACT_SCHEMA)
+        _migrate_messages(cur)
         c.commit()
 
-def upsert_account(cur, platform, handle, name, external_id, email, phone, extra):
-    cur.execute("""
-      INSERT INTO sm_accounts(platform,handle,name,external_id,email,phone,extra)
-      VALUES(%s,%s,%s,%s,%s,%s,%s)
-      ON CONFLICT (platform, COALESCE(handle,''), COALESCE(external_id,''))
-      DO UPDATE SET name=COALESCE(EXCLUDED.name, sm_accounts.name),
-                    email=COALESCE(EXCLUDED.email, sm_accounts.email),
-                    phone=COALESCE(EXCLUDED.phone, sm_accounts.phone)
-      RETURNING id
-    """,(platform, handle, name, external_id, email, phone, extra))
-    return cur.fetchone()[0]
+def _migrate_messages(cur):
+    """sm_messages.ingested_at لمهلة أمان العلامة المائية. العمود يُضاف بلا default ثم تُعلَّم
+    الصفوف الموجودة '-infinity' (قديمة) ثم SET DEFAULT now(): لو أُضيف بـ DEFAULT now() مباشرة
+    لحملت كل الصفوف الموجودة زمن الترحيل، فتقع داخل المهلة ولا يُجمع شيء في أول تشغيل."""
+    cur.execute("""SELECT 1 FROM information_schema.columns
+                   WHERE table_schema=current_schema() AND table_name='sm_messages' AND column_name='ingested_at'""")
+    if cur.fetchone(): return
+    cur.execute("SELECT to_regclass('sm_messages')")
+    if cur.fetchone()[0] is None: return   # ينشئه social-archive
+    cur.execute("ALTER TABLE sm_messages ADD COLUMN IF NOT EXISTS ingested_at TIMESTAMPTZ")
+    cur.execute("UPDATE sm_messages SET ingested_at='-infinity' WHERE ingested_at IS NULL")
+    cur.execute("ALTER TABLE sm_messages ALTER COLUMN ingested_at SET DEFAULT now()")
+
+def _merge_accounts(acc:dict, rows):
+    """dedup في الذاكرة بنفس دلالة ON CONFLICT المتتالي لكل رسالة: آخر قيمة غير فارغة تغلب، و extra الأول يبقى."""
+    for platform, h, name, ext, email, phone, src in rows:
+        k=(platform, h or ("name:"+name if name is not None else ""), ext or "")   # = ACCOUNT_KEY
+        cur=acc.get(k)
+        if cur is None:
+            acc[k]=[platform, h, name, ext, email, phone, src]
+        else:
+            if name is not None: cur[2]=name
+            if email is not None: cur[4]=email
+            if phone is not None: cur[5]=phone
+
+def _stream_messages(c, limit):
+    q="SELECT platform, author, peer, text FROM sm_messages"
+    params=None
+    if limit: q+=" ORDER BY ts DESC NULLS LAST LIMIT %s"; params=(limit,)
+    with c.cursor(name="sm_accounts_src") as cur:
+        cur.itersize=ITERSIZE
+        cur.execute(q, params)
+        while rows:=cur.fetchmany(ITERSIZE):
+            yield rows
+
+def bulk_upsert_accounts(c, accounts) -> dict:
+    """COPY إلى جدول مؤقت ثم INSERT ... SELECT ... ON CONFLICT واحد (الصفوف مُزالة التكرار مسبقاً)."""
+    with c.cursor() as cur:
+        cur.execute("""CREATE TEMP TABLE sm_accounts_stage(platform TEXT, handle TEXT, name TEXT, external_id TEXT,
+                       email TEXT, phone TEXT, extra JSONB) ON COMMIT DROP""")
+        with cur.copy("COPY sm_accounts_stage(platform,handle,name,external_id,email,phone,extra) FROM STDIN") as cp:
+            for platform, h, name, ext, email, phone, src in accounts:
+                cp.write_row((platform, h, name, ext, email, phone, json.dumps({"src":src})))
+        # العدّ في SQL: لا يعود إلى Python صف لكل حساب
+        cur.execute(f"""
+          WITH up AS (
+            INSERT INTO sm_accounts(platform,handle,name,external_id,email,phone,extra)
+            SELECT platform,handle,name,external_id,email,phone,extra FROM sm_accounts_stage
+            ON CONFLICT ({ACCOUNT_KEY})
+            DO UPDATE SET name=COALESCE(EXCLUDED.name, sm_accounts.name),
+                          email=COALESCE(EXCLUDED.email, sm_accounts.email),
+                          phone=COALESCE(EXCLUDED.phone, sm_accounts.phone)
+            RETURNING (xmax = 0) AS ins)
+          SELECT count(*) FILTER (WHERE ins), count(*) FILTER (WHERE NOT ins) FROM up
+        """)
+        inserted, updated=cur.fetchone()
+    return {"inserted":inserted, "updated":updated}
 
 def build_accounts_from_messages(limit:int|None=None):
+    """تدفق: cursor على الخادم → تطبيع متوازٍ (نافذة 2×العمال من الدفعات) → dedup → COPY + upsert واحد."""
     ensure_schema()
-    with db() as c, c.cursor() as cur:
-        q="SELECT platform, author, peer, text, ts FROM sm_messages"
-        if limit: q+= " ORDER BY ts DESC NULLS LAST LIMIT %s"
-        cur.execute(q, (limit,) if limit else None)
-        rows=cur.fetchall()
-        for platform, author, peer, text, ts in rows:
-            # author
-            h=norm_handle(author); name=(author if not h else None)
-            email=None; phone=None
-            if text:
-                em=EMAIL_RX.findall(text); ph=PHONE_RX.findall(text)
-                email=norm_email(em[0]) if em else None
-                phone=norm_phone(ph[0]) if ph else None
-            upsert_account(cur, platform, h, name, None, email, phone, {"src":"messages"})
-            # peer كمحاور
-            if peer:
-                hp=norm_handle(peer); namep=(peer if not hp else None)
-                upsert_account(cur, platform, hp, namep, None, None, None, {"src":"peer"})
+    t0=time.time(); n=0; acc={}; worker_stats={}
+    def take(fut):
+        rows, pid, st=fut.result()
+        worker_stats[pid]=st   # تراكمية لكل عامل: الأحدث يكفي
+        _merge_accounts(acc, rows)
+    with db() as c:
+        pool=norm_pool(); window=deque()
+        for rows in _stream_messages(c, limit):
+            n+=len(rows)
+            window.append(pool.submit(accounts_chunk, rows))
+            if len(window)>=2*NORM_WORKERS: take(window.popleft())
+        while window: take(window.popleft())
+        t1=time.time()
+        res=bulk_upsert_accounts(c, acc.values())
         c.commit()
+    dt=time.time()-t0
+    return {"messages":n, "accounts":len(acc), **res, "normalize_sec":round(t1-t0,3),
+            "upsert_sec":round(time.time()-t1,3), "elapsed_sec":round(dt,3),
+            "messages_per_sec":round(n/dt) if dt>0 and n else 0,
+            "norm_cache":normalize.merge_stats(worker_stats.values())}
 
 def neo_bootstrap():
     with bolt() as d, d.session() as s:
@@ -96,99 +146,195 @@ def push_accounts_to_graph():
     with bolt() as d, d.session() as s:
         s.run("""
         UNWIND $rows AS r
-        MERGE (a:Account {platform:r.platform, handle:coalesce(r.handle,'nohandle:'+toString(r.id))})
+        MERGE (a:Account {platform:r.platform, handle:r.key})
         SET a.name=coalesce(r.name,a.name), a.email=coalesce(r.email,a.email), a.phone=coalesce(r.phone,a.phone)
-        """, rows=[{"id":i,"platform":p,"handle":h,"name":n,"email":e,"phone":ph} for (i,p,h,n,e,ph) in acc])
+        """, rows=[{"key":graph_key(h,n,i),"platform":p,"name":n,"email":e,"phone":ph} for (i,p,h,n,e,ph) in acc])
+
+# ربط الأسماء المستعارة: كتل (blocks) بنفس الهاتف/البريد/الـ handle؛ كتلة أكبر من ALIAS_BLOCK_MAX
+# (رقم شركة أو قيمة افتراضية مزيفة) تُتخطى وتُذكر في الإحصاءات بدل توليد n² زوج
+ALIAS_BLOCK_MAX=int(os.getenv("ALIAS_BLOCK_MAX","50"))
+ALIAS_NAME_MIN=float(os.getenv("ALIAS_NAME_MIN","90"))
+ALIAS_BATCH=int(os.getenv("ALIAS_BATCH","5000"))
+# (المفتاح، الوزن، السبب) بترتيب القوة: الزوج الواحد يأخذ أقوى قاعدة
+ALIAS_RULES=(("phone",1.0,"phone"), ("email",0.95,"email"), ("handle",0.8,"handle+name"))
+
+ALIAS_CYPHER="""
+UNWIND $rows AS r
+MATCH (x:Account {platform:r.p1, handle:r.h1})
+MATCH (y:Account {platform:r.p2, handle:r.h2})
+MERGE (x)-[e:ALIAS_OF]->(y)
+WITH e, r WHERE e.weight IS NULL OR e.weight <= r.weight
+SET e.weight=r.weight, e.reason=r.reason, e += r.props
+"""
+
+def _graph_handle(a): return graph_key(a["handle"], a["name"], a["id"])
+
+def _alias_blocks(cur, col):
+    """الكتل ذات عضوين فأكثر؛ الأعضاء مرتبون بـ id (اتجاه الحافة ثابت عبر القواعد) ولا تُجلب للكتل المتخطاة."""
+    cur.execute(f"""SELECT {col}, count(*),
+                           CASE WHEN count(*)<=%s THEN json_agg(json_build_object('id',id,'platform',platform,
+                                'handle',handle,'name',name) ORDER BY id) END
+                    FROM sm_accounts WHERE {col} IS NOT NULL GROUP BY {col} HAVING count(*)>1""", (ALIAS_BLOCK_MAX,))
+    return cur.fetchall()
+
+def _block_pairs(col, key, a):
+    n=len(a)
+    if col!="handle":
+        return [(i,j,{col:key}) for i in range(n) for j in range(i+1,n)]
+    # handle: منصتان مختلفتان + تشابه اسم ≥ ALIAS_NAME_MIN؛ مصفوفة WRatio كاملة للكتلة بنداء cdist واحد
+    names=[x.get("name") or "" for x in a]
+    sim=cdist(names, names, scorer=fuzz.WRatio, score_cutoff=ALIAS_NAME_MIN, dtype=np.float32)
+    return [(i,j,{"name_sim":float(sim[i,j])})
+            for i,j in zip(*np.nonzero(np.triu(sim, 1)))
+            if names[i] and names[j] and a[i]["platform"]!=a[j]["platform"]]
 
 def link_rules():
-    # قاعدة 1: نفس الهاتف → ALIAS_OF وزن 1.0
+    t0=time.time(); stats={}; edges={}
     with db() as c, c.cursor() as cur:
-        cur.execute("""SELECT phone, array_agg(json_build_object('platform',platform,'handle',handle,'id',id,'name',name)) 
-                       FROM sm_accounts WHERE phone IS NOT NULL GROUP BY phone HAVING count(*)>1""")
-        same_phone=cur.fetchall()
-    # قاعدة 2: نفس البريد → ALIAS_OF وزن 0.95
-        cur.execute("""SELECT email, array_agg(json_build_object('platform',platform,'handle',handle,'id',id,'name',name)) 
-                       FROM sm_accounts WHERE email IS NOT NULL GROUP BY email HAVING count(*)>1""")
-        same_email=cur.fetchall()
-    # قاعدة 3: نفس الـ handle عبر منصتين + تشابه اسم ≥ 90 → ALIAS_OF وزن 0.8
-        cur.execute("""SELECT handle, array_agg(json_build_object('platform',platform,'handle',handle,'id',id,'name',name))
-                       FROM sm_accounts WHERE handle IS NOT NULL GROUP BY handle HAVING count(*)>1""")
-        same_handle=cur.fetchall()
-    # دفع للـ graph
+        for col, weight, reason in ALIAS_RULES:
+            t=time.time()
+            blocks=_alias_blocks(cur, col)
+            capped=[(k,n) for k,n,a in blocks if a is None]
+            pairs=0
+            for key, n, a in blocks:
+                if a is None: continue
+                for i,j,props in _block_pairs(col, key, a):
+                    x,y=a[int(i)],a[int(j)]; pairs+=1
+                    k=(x["platform"],_graph_handle(x),y["platform"],_graph_handle(y))
+                    if k not in edges:
+                        edges[k]={"p1":k[0],"h1":k[1],"p2":k[2],"h2":k[3],"weight":weight,"reason":reason,"props":props}
+            stats[col]={"blocks":len(blocks), "capped_blocks":len(capped),
+                        "capped_top":[{"key":k,"size":n} for k,n in sorted(capped, key=lambda x:-x[1])[:10]],
+                        "pairs":pairs, "elapsed_ms":round((time.time()-t)*1000,1)}
+    t=time.time(); rows=list(edges.values())
     with bolt() as d, d.session() as s:
-        # هاتف
-        for phone, arr in same_phone:
-            a=list(arr)
-            for i in range(len(a)):
-                for j in range(i+1,len(a)):
-                    s.run("""
-                    MATCH (x:Account {platform:$p1, handle:$h1}), (y:Account {platform:$p2, handle:$h2})
-                    MERGE (x)-[r:ALIAS_OF]->(y)
-                    SET r.weight=1.0, r.reason='phone', r.phone=$phone
-                    """, p1=a[i]['platform'], h1=a[i]['handle'], p2=a[j]['platform'], h2=a[j]['handle'], phone=phone)
-        # بريد
-        for email, arr in same_email:
-            a=list(arr)
-            for i in range(len(a)):
-                for j in range(i+1,len(a)):
-                    s.run("""
-                    MATCH (x:Account {platform:$p1, handle:$h1}), (y:Account {platform:$p2, handle:$h2})
-                    MERGE (x)-[r:ALIAS_OF]->(y)
-                    SET r.weight=0.95, r.reason='email', r.email=$email
-                    """, p1=a[i]['platform'], h1=a[i]['handle'], p2=a[j]['platform'], h2=a[j]['handle'], email=email)
-        # Handle + تشابه الاسم
-        for handle, arr in same_handle:
-            a=list(arr)
-            for i in range(len(a)):
-                for j in range(i+1,len(a)):
-                    n1=a[i].get('name') or ''
-                    n2=a[j].get('name') or ''
-                    sim=fuzz.WRatio(n1, n2) if n1 and n2 else 0
-                    if a[i]['platform']!=a[j]['platform'] and sim>=90:
-                        s.run("""
-                        MATCH (x:Account {platform:$p1, handle:$h}), (y:Account {platform:$p2, handle:$h})
-                        MERGE (x)-[r:ALIAS_OF]->(y)
-                        SET r.weight=0.8, r.reason='handle+name', r.name_sim=$sim
-                        """, p1=a[i]['platform'], p2=a[j]['platform'], h=handle, sim=float(sim))
-    return {"linked_phone":len(same_phone), "linked_email":len(same_email), "linked_handle_groups":len(same_handle)}
-
-def build_contact_edges(limit:int|None=None):
-    # تحويل الرسائل إلى CONTACTED(count, first_ts, last_ts)
+        for i in range(0, len(rows), ALIAS_BATCH):
+            s.run(ALIAS_CYPHER, rows=rows[i:i+ALIAS_BATCH]).consume()
+    return {"rules":stats, "edges":len(rows), "block_max":ALIAS_BLOCK_MAX,
+            "write_ms":round((time.time()-t)*1000,1), "elapsed_sec":round(time.time()-t0,3)}
+
+# CONTACTED: Postgres يجمع الرسائل الجديدة حسب الأزواج الخام (platform, author, peer) — الصادرات تكرر
+# نفس الأزواج، فالناتج أصغر بكثير — ثم تُطبّع القيم المميزة بـ norm_handles (نفس مفاتيح الحسابات،
+# بمخابئها) وتُدمج في sm_contact_rollup بـ COPY + GROUP BY واحد، تزايدياً فوق علامة مائية على
+# sm_messages.id؛ ثم تُبث الأزواج التي تغيّرت فقط إلى Neo4j بدفعات UNWIND بإجماليات مطلقة
+CONTACT_BATCH=int(os.getenv("CONTACT_BATCH","5000"))
+# لا تُعالج رسائل أُدرجت خلال آخر ETL_SAFETY_LAG_SEC: id يُحجز قبل commit، فمعاملة أبطأ قد تُظهر
+# id أصغر من علامة تقدمت فوقه
+ETL_SAFETY_LAG_SEC=float(os.getenv("ETL_SAFETY_LAG_SEC","5"))
+
+CONTACT_SCHEMA="""
+CREATE TABLE IF NOT EXISTS sm_contact_rollup(
+  platform TEXT NOT NULL, src TEXT NOT NULL, dst TEXT NOT NULL,
+  n BIGINT NOT NULL, first_ts TIMESTAMPTZ, last_ts TIMESTAMPTZ,
+  updated_seq BIGINT NOT NULL,
+  PRIMARY KEY(platform, src, dst)
+);
+CREATE INDEX IF NOT EXISTS sm_contact_rollup_seq ON sm_contact_rollup(updated_seq);
+CREATE TABLE IF NOT EXISTS sm_etl_watermarks(
+  name TEXT PRIMARY KEY, last_id BIGINT NOT NULL DEFAULT 0, pushed_seq BIGINT NOT NULL DEFAULT 0,
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+"""
+
+# أعلى id آمن: قبل أول رسالة ما زالت ضمن مهلة الأمان، وإلا آخر رسالة
+CONTACT_HI_SQL="""
+SELECT coalesce((SELECT min(id)-1 FROM sm_messages
+                 WHERE id>%(lo)s AND ingested_at>=now()-make_interval(secs=>%(lag)s)),
+                (SELECT max(id) FROM sm_messages WHERE id>%(lo)s))
+"""
+
+CONTACT_RAW_SQL="""
+SELECT platform, author, peer, count(*), min(ts), max(ts)
+FROM sm_messages
+WHERE id > %(lo)s AND id <= %(hi)s AND platform IS NOT NULL AND author IS NOT NULL AND peer IS NOT NULL
+GROUP BY 1,2,3
+"""
+
+CONTACT_ROLLUP_SQL="""
+INSERT INTO sm_contact_rollup(platform,src,dst,n,first_ts,last_ts,updated_seq)
+SELECT platform, src, dst, sum(n), min(first_ts), max(last_ts), %(hi)s
+FROM sm_contact_stage GROUP BY 1,2,3
+ON CONFLICT (platform,src,dst) DO UPDATE SET
+  n=sm_contact_rollup.n+EXCLUDED.n,
+  first_ts=LEAST(sm_contact_rollup.first_ts, EXCLUDED.first_ts),
+  last_ts=GREATEST(sm_contact_rollup.last_ts, EXCLUDED.last_ts),
+  updated_seq=EXCLUDED.updated_seq
+"""
+
+CONTACT_CYPHER="""
+UNWIND $rows AS r
+MERGE (a:Account {platform:r.p, handle:r.src}) ON CREATE SET a.name=r.src_name
+MERGE (b:Account {platform:r.p, handle:r.dst}) ON CREATE SET b.name=r.dst_name
+MERGE (a)-[e:CONTACTED]->(b)
+SET e.count=r.n, e.first_ts=r.first_ts, e.last_ts=r.last_ts
+"""
+
+def _contact_row(p, src, dst, n, f, l):
+    return {"p":p, "src":src, "dst":dst, "n":n, "first_ts":f, "last_ts":l,
+            "src_name":graph_key_name(src), "dst_name":graph_key_name(dst)}
+
+def build_contact_edges(limit:int|None=None, full:bool=False):
+    """limit: أقصى عدد رسائل جديدة في هذا التشغيل (الباقي للتشغيل التالي)؛ full: إعادة بناء من الصفر."""
+    ensure_schema()   # ترحيل sm_messages في معاملة مستقلة قبل قراءة العلامة
+    t0=time.time()
     with db() as c, c.cursor() as cur:
-        q="SELECT platform, author, peer, ts FROM sm_messages WHERE author IS NOT NULL AND peer IS NOT NULL"
-        if limit: q+=" ORDER BY ts DESC NULLS LAST LIMIT %s"
-        cur.execute(q, (limit,) if limit else None)
-        rows=cur.fetchall()
-    agg={}
-    for platform, author, peer, ts in rows:
-        h1=norm_handle(author) or f"name:{author}"
-        h2=norm_handle(peer) or f"name:{peer}"
-        key=(platform,h1,h2)
-        d=agg.get(key, {"count":0, "first":ts, "last":ts})
-        d["count"]+=1
-        d["first"]=min(d["first"], ts) if d["first"] and ts else d["first"] or ts
-        d["last"]=max(d["last"], ts) if d["last"] and ts else d["last"] or ts
-        agg[key]=d
-    with bolt() as d, d.session() as s:
-        for (platform,h1,h2),meta in agg.items():
-            # نستخدم handle إن وجد وإلا نضع وسم name:
-            handle1=h1 if not h1.startswith("name:") else None
-            name1=h1[5:] if h1 and h1.startswith("name:") else None
-            handle2=h2 if not h2.startswith("name:") else None
-            name2=h2[5:] if h2 and h2.startswith("name:") else None
-            s.run("""
-            MERGE (a:Account {platform:$p, handle:coalesce($h1, 'nohandle:'+toString(id(a)))})
-            ON CREATE SET a.name=$n1
-            MERGE (b:Account {platform:$p, handle:coalesce($h2, 'nohandle:'+toString(id(b)))})
-            ON CREATE SET b.name=$n2
-            MERGE (a)-[r:CONTACTED]->(b)
-            SET r.count=coalesce(r.count,0)+$c, r.first_ts=coalesce(r.first_ts,$f), r.last_ts=CASE WHEN r.last_ts IS NULL OR $l>r.last_ts THEN $l ELSE r.last_ts END
-            """, p=platform, h1=handle1, n1=name1, h2=handle2, n2=name2, c=meta["count"], f=meta["first"], l=meta["last"])
-    return {"pairs":len(agg)}
+        if full:
+            cur.execute("TRUNCATE sm_contact_rollup")
+            cur.execute("DELETE FROM sm_etl_watermarks WHERE name='contacts'")
+        cur.execute("INSERT INTO sm_etl_watermarks(name) VALUES('contacts') ON CONFLICT DO NOTHING")
+        cur.execute("SELECT last_id, pushed_seq FROM sm_etl_watermarks WHERE name='contacts' FOR UPDATE")
+        lo, pushed=cur.fetchone()
+        cur.execute(CONTACT_HI_SQL, {"lo":lo, "lag":ETL_SAFETY_LAG_SEC})
+        hi=cur.fetchone()[0] or lo
+        if limit and hi>lo:
+            cur.execute("SELECT max(id) FROM (SELECT id FROM sm_messages WHERE id>%s AND id<=%s ORDER BY id LIMIT %s) t",
+                        (lo, hi, limit))
+            hi=cur.fetchone()[0] or lo
+        pairs=raw_pairs=0
+        if hi>lo:
+            cur.execute("""CREATE TEMP TABLE sm_contact_stage(platform TEXT, src TEXT, dst TEXT, n BIGINT,
+                           first_ts TIMESTAMPTZ, last_ts TIMESTAMPTZ) ON COMMIT DROP""")
+            with c.cursor(name="sm_contact_src") as src:
+                src.itersize=CONTACT_BATCH
+                src.execute(CONTACT_RAW_SQL, {"lo":lo, "hi":hi})
+                while rows:=src.fetchmany(CONTACT_BATCH):
+                    raw_pairs+=len(rows)
+                    authors=norm_handles([r[1] for r in rows]); peers=norm_handles([r[2] for r in rows])
+                    with cur.copy("COPY sm_contact_stage(platform,src,dst,n,first_ts,last_ts) FROM STDIN") as cp:
+                        for (platform, author, peer, n, f, l), a, b in zip(rows, authors, peers):
+                            cp.write_row((platform, graph_key(a, author), graph_key(b, peer), n, f, l))
+            cur.execute(CONTACT_ROLLUP_SQL, {"hi":hi}); pairs=cur.rowcount
+            cur.execute("UPDATE sm_etl_watermarks SET last_id=%s, updated_at=now() WHERE name='contacts'", (hi,))
+        c.commit()
+    t1=time.time(); pushed_rows=0; batches=0
+    with db() as c, bolt() as d, d.session() as s:
+        with c.cursor(name="sm_contact_push") as cur:
+            cur.itersize=CONTACT_BATCH
+            cur.execute("SELECT platform,src,dst,n,first_ts,last_ts FROM sm_contact_rollup WHERE updated_seq>%s", (pushed,))
+            while rows:=cur.fetchmany(CONTACT_BATCH):
+                s.run(CONTACT_CYPHER, rows=[_contact_row(*r) for r in rows]).consume()
+                pushed_rows+=len(rows); batches+=1
+        c.execute("UPDATE sm_etl_watermarks SET pushed_seq=%s, updated_at=now() WHERE name='contacts'", (hi,))
+        c.commit()
+    return {"from_id":lo, "to_id":hi, "raw_pairs":raw_pairs, "pairs_updated":pairs, "pairs_pushed":pushed_rows, "batches":batches,
+            "rollup_sec":round(t1-t0,3), "push_sec":round(time.time()-t1,3)}
+
+@api.get("/contacts_status")
+def contacts_status():
+    ensure_schema()
+    with db() as c, c.cursor() as cur:
+        cur.execute("SELECT last_id, pushed_seq, updated_at FROM sm_etl_watermarks WHERE name='contacts'")
+        wm=cur.fetchone()
+        cur.execute("SELECT count(*), coalesce(sum(n),0) FROM sm_contact_rollup")
+        pairs, msgs=cur.fetchone()
+        c.commit()
+    return {"last_id":wm[0] if wm else 0, "pushed_seq":wm[1] if wm else 0, "updated_at":wm[2] if wm else None,
+            "pairs":pairs, "messages":msgs}
 
 class RunReq(BaseModel):
     limit:int|None=None
     push_only:bool|None=False
+    full_contacts:bool=False
 
 @api.get("/health")
 def health():
@@ -199,17 +345,27 @@ def health():
     except Exception as e:
         return {"status":"bad","error":str(e)}
 
+@api.get("/norm_stats")
+def norm_stats():
+    """مخابئ التطبيع في عملية الـ API (build_contact_edges)؛ إحصاءات عمال استخراج الحسابات تعود مع /build."""
+    return {"default_region":normalize.DEFAULT_REGION, "cache":normalize.cache_stats()}
+
 @api.post("/bootstrap")
 def bootstrap():
     ensure_schema(); neo_bootstrap()
     return {"ok":True}
 
+@api.on_event("shutdown")
+def shutdown():
+    if _pool is not None: _pool.shutdown(cancel_futures=True)
+
 @api.post("/build")
 def build(req:RunReq):
-    build_accounts_from_messages(req.limit)
+    accounts=build_accounts_from_messages(req.limit)
     neo_bootstrap()
     push_accounts_to_graph()
+    out={"done":True, "accounts":accounts}
     if not req.push_only:
-        link_rules()
-        build_contact_edges(req.limit)
-    return {"done":True}
+        out["aliases"]=link_rules()
+        out["contacts"]=build_contact_edges(req.limit, req.full_contacts)
+    return out
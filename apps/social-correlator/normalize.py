@@ -0,0 +1,108 @@
+"""تطبيع المعرّفات (handle / بريد / هاتف) واستخراجها من الرسائل.
+
+وحدة خفيفة بلا اتصالات قواعد بيانات: تُستورد في عمال ProcessPoolExecutor
+(spawn) دون تحميل FastAPI أو برامج التشغيل.
+
+صادرات المحادثات تكرر نفس بضعة آلاف من الأسماء والأرقام ملايين المرات، فكل
+دالة تطبيع خلف lru_cache محدود (NORM_CACHE_SIZE لكل نوع، لكل عملية) و
+cache_stats() تعطي نسبة الإصابة. دوال الدفعات (norm_handles / norm_phones)
+تطبّع القيم المميزة مرة واحدة فقط. PHONE_DEFAULT_REGION (ISO مثل JO أو SA)
+يسمح بتحليل الأرقام المحلية بلا +؛ بدونه تُسقط كما كان.
+"""
+import os, re
+from functools import lru_cache
+import phonenumbers
+
+HANDLE_RX=re.compile(r"^@?([A-Za-z0-9._-]{3,})$")
+EMAIL_RX=re.compile(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}")
+PHONE_RX=re.compile(r"\+?\d[\d\s().-]{6,}")
+
+CACHE_SIZE=int(os.getenv("NORM_CACHE_SIZE","200000"))
+DEFAULT_REGION=(os.getenv("PHONE_DEFAULT_REGION") or "").upper() or None
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _handle(s:str):
+    m=HANDLE_RX.match(s.strip())
+    return m.group(1).lower() if m else None
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _email(s:str): return s.strip().lower()
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _phone(s:str, region:str|None):
+    try:
+        p=phonenumbers.parse(s, region)
+        if phonenumbers.is_possible_number(p) and phonenumbers.is_valid_number(p):
+            return phonenumbers.format_number(p, phonenumbers.PhoneNumberFormat.E164)
+    except Exception: pass
+    return None
+
+def norm_handle(s:str|None):
+    return _handle(s) if s else None
+
+def norm_email(s:str): return _email(s)
+
+def norm_phone(s:str, region:str|None=None):
+    return _phone(s.strip(), region or DEFAULT_REGION)
+
+def norm_handles(values) -> list:
+    """دفعة: كل قيمة مميزة تُطبّع مرة واحدة، والنتيجة بنفس ترتيب values."""
+    m={v:norm_handle(v) for v in set(values)}
+    return [m[v] for v in values]
+
+def norm_phones(values, region:str|None=None) -> list:
+    m={v:(norm_phone(v, region) if v else None) for v in set(values)}
+    return [m[v] for v in values]
+
+def cache_stats() -> dict:
+    out={}
+    for name, f in (("handle",_handle), ("email",_email), ("phone",_phone)):
+        ci=f.cache_info(); n=ci.hits+ci.misses
+        out[name]={"hits":ci.hits, "misses":ci.misses, "size":ci.currsize, "maxsize":ci.maxsize,
+                   "hit_rate":round(ci.hits/n,4) if n else None}
+    return out
+
+def merge_stats(stats) -> dict:
+    """يجمع cache_stats من عدة عمليات (عمال الـ pool)."""
+    out={}
+    for st in stats:
+        for name, s in st.items():
+            o=out.setdefault(name, {"hits":0, "misses":0, "size":0})
+            for k in o: o[k]+=s[k]
+    for o in out.values():
+        n=o["hits"]+o["misses"]; o["hit_rate"]=round(o["hits"]/n,4) if n else None
+    return out
+
+def graph_key(handle, name, id=None) -> str:
+    """مفتاح Account في Neo4j (مع platform)، واحد للحسابات و ALIAS_OF و CONTACTED: الـ handle
+    المُطبّع، وإلا name:<الاسم الخام>، وإلا nohandle:<id> لصف sm_accounts بلا أيهما."""
+    if handle: return handle
+    if name is not None: return f"name:{name}"
+    return f"nohandle:{id}"
+
+def graph_key_name(key: str):
+    """الاسم الخام من مفتاح name:<...> (لـ a.name عند الإنشاء)، وإلا None."""
+    return key[5:] if key.startswith("name:") else None
+
+def accounts_from_messages(rows):
+    """(platform, author, peer, text) → حسابات (platform, handle, name, external_id, email, phone, src)
+    بنفس ترتيب الرسائل: الكاتب ثم المحاور."""
+    rows=list(rows)
+    authors=norm_handles([r[1] for r in rows]); peers=norm_handles([r[2] for r in rows])
+    emails, phones=[], []
+    for r in rows:
+        text=r[3]
+        em=EMAIL_RX.search(text) if text else None; ph=PHONE_RX.search(text) if text else None
+        emails.append(norm_email(em.group(0)) if em else None)
+        phones.append(ph.group(0) if ph else None)
+    phones=norm_phones(phones)
+    out=[]
+    for (platform, author, peer, _), h, hp, email, phone in zip(rows, authors, peers, emails, phones):
+        out.append((platform, h, (author if not h else None), None, email, phone, "messages"))
+        if peer:
+            out.append((platform, hp, (peer if not hp else None), None, None, None, "peer"))
+    return out
+
+def accounts_chunk(rows):
+    """مهمة الـ pool: الحسابات مع pid و cache_stats التراكمية لهذا العامل."""
+    return accounts_from_messages(rows), os.getpid(), cache_stats()
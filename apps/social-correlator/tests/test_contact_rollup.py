@@ -0,0 +1,90 @@
+"""CONTACTED من sm_messages موجود مسبقاً: أول تشغيل بعد الترحيل يجمع كل الرسائل.
+
+يحتاج Postgres حقيقياً: TEST_PG_DSN، أو pgserver إن كان مثبتاً؛ وإلا يُتخطى.
+"""
+import os, sys, tempfile
+import pytest
+import psycopg
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+
+MESSAGES = [
+    # (platform, author, peer)
+    ("tg", "@Alice", "bob"), ("tg", " alice ", "@bob"), ("tg", "\u00a0@alice", "Bob"),
+    ("tg", "Abu Ali", "bob"), ("tg", "Umm Ali", "bob"), ("wa", "+15550001", "carol"), ("tg", "bob", "@alice"),
+]
+
+@pytest.fixture(scope="module")
+def dsn():
+    if os.getenv("TEST_PG_DSN"): yield os.environ["TEST_PG_DSN"]; return
+    pgserver = pytest.importorskip("pgserver")
+    srv = pgserver.get_server(tempfile.mkdtemp(), cleanup_mode="stop")
+    yield srv.get_uri()
+
+class StubSession:
+    def __init__(self, log): self.log = log
+    def __enter__(self): return self
+    def __exit__(self, *a): pass
+    def run(self, cypher, **params):
+        self.log.append((cypher, params)); return self
+    def consume(self): pass
+
+class StubDriver:
+    def __init__(self): self.log = []
+    def __enter__(self): return self
+    def __exit__(self, *a): pass
+    def session(self): return StubSession(self.log)
+
+@pytest.fixture
+def env(dsn, monkeypatch):
+    with psycopg.connect(dsn, autocommit=True) as c:
+        c.execute("DROP TABLE IF EXISTS sm_messages, sm_contact_rollup, sm_etl_watermarks, sm_accounts CASCADE")
+        # نفس جدول social-archive قبل الترحيل (بلا ingested_at)
+        c.execute("""CREATE TABLE sm_messages(id BIGSERIAL PRIMARY KEY, platform TEXT, ts TIMESTAMPTZ,
+                     author TEXT, peer TEXT, text TEXT, media JSONB, extra JSONB)""")
+        for i, (p, a, b) in enumerate(MESSAGES):
+            c.execute("INSERT INTO sm_messages(platform,ts,author,peer) VALUES(%s, now() - make_interval(days=>%s), %s, %s)",
+                      (p, len(MESSAGES) - i, a, b))
+    driver = StubDriver()
+    monkeypatch.setattr(app, "db", lambda: psycopg.connect(dsn))
+    monkeypatch.setattr(app, "bolt", lambda: driver)
+    return dsn, driver
+
+def rollup(dsn):
+    with psycopg.connect(dsn) as c:
+        return {(p, s, d): n for p, s, d, n in c.execute("SELECT platform, src, dst, n FROM sm_contact_rollup")}
+
+def test_prepopulated_messages_rolled_up_on_first_run(env):
+    dsn, driver = env
+    out = app.build_contact_edges()
+    assert out["to_id"] == len(MESSAGES)
+    r = rollup(dsn)
+    assert sum(r.values()) == len(MESSAGES)
+    # نفس مفاتيح norm_handle (بما فيها المسافات غير ASCII) مثل مسار الحسابات
+    assert r[("tg", "alice", "bob")] == 3
+    assert out["pairs_pushed"] == len(r) == sum(len(p["rows"]) for _, p in driver.log)
+
+def test_new_messages_wait_for_safety_lag(env, monkeypatch):
+    dsn, driver = env
+    app.build_contact_edges()
+    with psycopg.connect(dsn) as c:
+        c.execute("INSERT INTO sm_messages(platform,ts,author,peer) VALUES('tg', now(), 'alice', 'bob')")
+    assert app.build_contact_edges()["to_id"] == len(MESSAGES)   # داخل المهلة: لا تقدّم
+    monkeypatch.setattr(app, "ETL_SAFETY_LAG_SEC", 0.0)
+    out = app.build_contact_edges()
+    assert out["to_id"] == len(MESSAGES) + 1 and out["pairs_pushed"] == 1
+    assert rollup(dsn)[("tg", "alice", "bob")] == 4
+
+def test_accounts_and_contacts_share_keys(env):
+    dsn, driver = env
+    out = app.build_accounts_from_messages()
+    # حسابان بلا handle في نفس المنصة لا ينطويان في صف واحد
+    with psycopg.connect(dsn) as c:
+        names = {n for (n,) in c.execute("SELECT name FROM sm_accounts WHERE handle IS NULL")}
+    assert {"Abu Ali", "Umm Ali"} <= names
+    assert out["inserted"] == out["accounts"]
+    app.push_accounts_to_graph(); app.build_contact_edges()
+    accounts = {(r["platform"], r["key"]) for cy, p in driver.log if "handle:r.key" in cy for r in p["rows"]}
+    contacts = {(r["p"], k) for cy, p in driver.log if "CONTACTED" in cy for r in p["rows"] for k in (r["src"], r["dst"])}
+    assert ("tg", "name:Abu Ali") in contacts and contacts <= accounts
@@ -15,8 +15,11 @@ CREATE TABLE IF NOT EXISTS transcripts(
   media_id UUID REFERENCES media_assets(id) ON DELETE CASCADE,
   lang TEXT,
   text TEXT,
+  model_version TEXT,     -- ASR+NER pipeline version (ingest dedup key)
   created_at TIMESTAMPTZ DEFAULT now()
 );
+-- transcript used by this media row (its own, or the cached one on a dedup hit)
+ALTER TABLE media_assets ADD COLUMN IF NOT EXISTS transcript_id UUID REFERENCES transcripts(id) ON DELETE SET NULL;
 
 CREATE TABLE IF NOT EXISTS nlp_entities(
   id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
@@ -33,3 +36,23 @@ CREATE TABLE IF NOT EXISTS entity_mentions(
   entity_id UUID REFERENCES nlp_entities(id) ON DELETE CASCADE,
   start_char INT, end_char INT
 );
+
+CREATE TABLE IF NOT EXISTS ingest_jobs(
+  id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+  status TEXT NOT NULL DEFAULT 'queued',   -- queued | running | done | failed
+  stage TEXT,             -- ffmpeg | asr | db | ner | graph | done
+  progress REAL DEFAULT 0,
+  payload JSONB NOT NULL,
+  result JSONB,
+  error TEXT,
+  attempts INT DEFAULT 0,
+  locked_by TEXT,
+  locked_until TIMESTAMPTZ,
+  created_at TIMESTAMPTZ DEFAULT now(),
+  updated_at TIMESTAMPTZ DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS ingest_jobs_status_idx ON ingest_jobs(status, created_at);
+
+CREATE INDEX IF NOT EXISTS media_assets_sha256_idx ON media_assets(sha256);
+CREATE INDEX IF NOT EXISTS transcripts_media_model_idx ON transcripts(media_id, model_version);
+CREATE INDEX IF NOT EXISTS entity_mentions_transcript_idx ON entity_mentions(transcript_id);